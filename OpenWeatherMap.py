@@ -1,367 +1,821 @@
 import telegram
-from telegram.ext import Updater, CommandHandler
+from telegram.ext import Dispatcher, Updater, CommandHandler
+from telegram.utils.request import Request
 import requests
-from datetime import datetime
-import sqlite3
 import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
 from config import Config
+import metrics
+from cache_backend import open_backend
+from city_index import City, load_city_index
+from forecast_store import ForecastStore
+from rate_limit import TokenBucket
+from refresher import Refresher
+from rendering import LANGUAGES, Renderer, city_timezone
+from scheduler import SendQueue, SubscriptionScheduler
+from storage import EMPTY_PROFILE, Database, ProfileStore, SubscriptionStore, UserStore
+from weather_cache import WeatherCache, normalize_city
+from upstream_guard import CircuitBreaker, UpstreamGuard, UpstreamUnavailableError
+from weather_client import WeatherClient
+from webhook import WebhookPool
 
-def create_users_table():
-    conn = sqlite3.connect(Config.DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            is_registered INTEGER DEFAULT 0
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-def register_user(user_id, username):
-    conn = sqlite3.connect(Config.DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO users (user_id, username, is_registered) VALUES (?, ?, 1)', (user_id, username))
-    conn.commit()
-    conn.close()
-
-def check_registration(user_id):
-    conn = sqlite3.connect(Config.DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT is_registered FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result and result[0] == 1
+# Прогноз по умолчанию на сутки; OpenWeatherMap отдает ряд на 5 дней
+FORECAST_DEFAULT_HOURS = 24
+FORECAST_MAX_HOURS = 120
+
+TIME_PATTERN = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+
+# Зависимости обработчиков команд; создаются в setup_components() по настройкам
+config = Config
+database = None
+user_store = None
+subscription_store = None
+profile_store = None
+cache_backend = None
+weather_cache = None
+upstream_guard = None
+weather_client = None
+renderer = None
+forecast_store = None
+refresher = None
+
+# Локальный индекс городов; загружается в open_resources(), None - поиск по названию через API
+city_index = None
+
+def setup_components(settings=Config):
+    """Создает хранилища, кэши, клиент API и фоновое обновление по настройкам settings
+
+    Единственное место сборки зависимостей обработчиков: его вызывают main(),
+    каждый воркер webhook и нагрузочный тест (с подмененными настройками).
+    Хранилища открываются отдельно, в open_resources().
+    """
+    global config, database, user_store, subscription_store, profile_store, cache_backend, weather_cache
+    global upstream_guard, weather_client, renderer, forecast_store, refresher
+    config = settings
+
+    # Хранилища пользователей и подписок с постоянными соединениями к SQLite
+    database = Database(settings.DATABASE_NAME)
+    user_store = UserStore(
+        database,
+        batch_size=settings.USERS_BATCH_SIZE,
+        flush_interval=settings.USERS_FLUSH_INTERVAL,
+    )
+    subscription_store = SubscriptionStore(database)
+
+    # Настройки пользователей (город по умолчанию, единицы, язык) в памяти с отложенной записью в базу.
+    # В режиме webhook команды пользователя из разных чатов попадают в разные процессы, поэтому
+    # настройки перечитываются из базы раз в PROFILE_CACHE_TTL секунд
+    profile_store = ProfileStore(
+        database,
+        max_size=settings.PROFILE_CACHE_SIZE,
+        flush_interval=settings.PROFILE_FLUSH_INTERVAL,
+        ttl=settings.PROFILE_CACHE_TTL if settings.BOT_MODE == 'webhook' else None,
+    )
+
+    # Общий для процессов кэш второго уровня (SQLite или Redis), переживающий перезапуск бота
+    cache_backend = open_backend(settings.CACHE_BACKEND_URL, settings.CACHE_BACKEND_SIZE, settings.CACHE_RETENTION)
+
+    # Общий кэш текущей погоды для /weather, /sunrise, /sunset, /humidity, /wind и /pressure
+    weather_cache = WeatherCache(ttl=settings.WEATHER_CACHE_TTL, max_size=settings.WEATHER_CACHE_SIZE,
+                                 backend=cache_backend)
+
+    # Процессы, которые обращаются к API: в режиме webhook - воркеры и главный процесс
+    # (прогрев кэша и рассылка подписок); лимит тарифа и всплеск делятся между ними поровну
+    api_processes = settings.WEBHOOK_PROCESSES + 1 if settings.BOT_MODE == 'webhook' else 1
+
+    # Общая защита API: лимит запросов по тарифу, повторы с задержкой и circuit breaker
+    upstream_guard = UpstreamGuard(
+        bucket=TokenBucket(settings.OPENWEATHER_CALLS_PER_MINUTE / 60 / api_processes,
+                           max(settings.OPENWEATHER_BURST / api_processes, 1)),
+        breaker=CircuitBreaker(settings.OPENWEATHER_BREAKER_THRESHOLD, settings.OPENWEATHER_BREAKER_RESET),
+        retries=settings.OPENWEATHER_RETRIES,
+        backoff_base=settings.OPENWEATHER_BACKOFF_BASE,
+        backoff_max=settings.OPENWEATHER_BACKOFF_MAX,
+        rate_wait=settings.OPENWEATHER_RATE_WAIT,
+    )
+
+    # Единый клиент OpenWeatherMap с пулом соединений для всех обработчиков
+    weather_client = WeatherClient(
+        base_url=settings.OPENWEATHER_BASE_URL,
+        api_key=settings.OPENWEATHER_API_KEY,
+        units=settings.WEATHER_UNITS,
+        lang=settings.WEATHER_LANG,
+        cache=weather_cache,
+        timeout=settings.OPENWEATHER_TIMEOUT,
+        max_connections=settings.OPENWEATHER_MAX_CONNECTIONS,
+        max_concurrency=settings.OPENWEATHER_MAX_CONCURRENCY,
+        guard=upstream_guard,
+        stale_fallback=settings.STALE_FALLBACK,
+        batch_workers=settings.OPENWEATHER_BATCH_WORKERS,
+    )
+
+    # Тексты ответов по шаблонам языка и единиц; готовые ответы по одним и тем же данным переиспользуются
+    renderer = Renderer(ttl=settings.WEATHER_CACHE_TTL, max_size=settings.RENDER_CACHE_SIZE)
+
+    # Полные пятидневные прогнозы по городам; один запрос к API обслуживает все вопросы о прогнозе
+    forecast_store = ForecastStore(weather_client, max_size=settings.FORECAST_STORE_SIZE,
+                                   stale_fallback=settings.STALE_FALLBACK, backend=cache_backend)
+
+    # Фоновое обновление популярных городов на доле лимита API; в режиме webhook доля делится между воркерами
+    refresher = Refresher(
+        weather_client,
+        forecast_store,
+        bucket=TokenBucket(settings.OPENWEATHER_CALLS_PER_MINUTE / 60 * settings.REFRESH_QUOTA_SHARE
+                           / (settings.WEBHOOK_PROCESSES if settings.BOT_MODE == 'webhook' else 1)),
+        top_k=settings.REFRESH_TOP_K,
+        lead=settings.REFRESH_LEAD,
+        interval=settings.REFRESH_INTERVAL,
+        half_life=settings.REFRESH_HALF_LIFE,
+        min_score=settings.REFRESH_MIN_REQUESTS,
+        forecast_gap=settings.REFRESH_FORECAST_GAP,
+    ) if settings.REFRESH_QUOTA_SHARE > 0 else None
+
+def city_key(location):
+    """Ключ города для группировки подписчиков: id из индекса или нормализованное название"""
+    if isinstance(location, City):
+        return f'id:{location.id}'
+    return f'q:{normalize_city(location)}'
+
+def resolve_city(city, profile=None):
+    """Находит город в локальном индексе; без индекса запрос уходит в API по названию
+
+    profile - настройки спросившего: популярность города учитывается вместе с его единицами и языком.
+    """
+    location = city if city_index is None else city_index.resolve(city)
+    if location is not None and refresher is not None:
+        if profile is None:
+            refresher.record(location)
+        else:
+            refresher.record(location, profile.units, profile.lang)
+    return location
+
+def user_profile(update):
+    """Настройки пользователя из памяти с подставленными значениями бота по умолчанию
+
+    Для обновлений без пользователя (например, в обработчике ошибок) - настройки бота.
+    """
+    user = update.effective_user
+    profile = profile_store.get(user.id) if user is not None else EMPTY_PROFILE
+    return profile._replace(units=profile.units or Config.WEATHER_UNITS, lang=profile.lang or Config.WEATHER_LANG)
 
 def start(update, context):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     username = update.effective_user.username
+    profile = user_profile(update)
 
-    if not check_registration(user_id):
-        register_user(user_id, username)
-        message = f"Привет, {username}! Вы успешно зарегистрированы. Введите команду /help, чтобы получить список доступных команд."
-    else:
-        message = f"С возвращением, {username}! Введите команду /help, чтобы получить список доступных команд."
+    kind = 'welcome' if user_store.register(user_id, username) else 'welcome_back'
+    message = renderer.text(kind, profile.lang, profile.units, username=username)
 
     context.bot.send_message(chat_id=chat_id, text=message)
 
 def weather(update, context):
     chat_id = update.effective_chat.id
     
-    if not context.args:
-        context.bot.send_message(chat_id=chat_id, text='Пожалуйста, укажите название города. Пример: /weather Москва')
+    profile = user_profile(update)
+    city = ' '.join(context.args) or profile.city
+    if not city:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('usage_city', profile.lang, profile.units, command='weather'))
         return
     
-    city = ' '.join(context.args)
+    location = resolve_city(city, profile)
+    if location is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
     
     try:
-        url = f'{Config.OPENWEATHER_BASE_URL}/weather?q={city}&appid={Config.OPENWEATHER_API_KEY}&units={Config.WEATHER_UNITS}&lang={Config.WEATHER_LANG}'
-        
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = weather_client.current(location, units=profile.units, lang=profile.lang)
         
         if data.get('cod') != 200:
-            context.bot.send_message(chat_id=chat_id, text=f'Город "{city}" не найден. Проверьте правильность написания.')
+            context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
             return
         
-        temperature = int(data['main']['temp'])
-        description = data['weather'][0]['description']
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        message = f'Текущая погода в городе {city}:\n'
-        message += f'{current_time}: {temperature}°C, {description}'
+        message = renderer.current('weather', city, data, profile.lang, profile.units)
         
         context.bot.send_message(chat_id=chat_id, text=message)
         
     except requests.exceptions.RequestException as e:
         logging.error(f'Ошибка при запросе погоды: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла ошибка при получении данных о погоде. Попробуйте позже.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_weather', profile.lang, profile.units))
     except KeyError as e:
         logging.error(f'Ошибка в структуре данных API: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Получены некорректные данные от сервиса погоды.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_bad_data', profile.lang, profile.units))
     except Exception as e:
         logging.error(f'Неожиданная ошибка: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла неожиданная ошибка.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_unexpected', profile.lang, profile.units))
+
+def parse_forecast_args(args, default_city=None):
+    """Разбирает /forecast [город] [часы|завтра]: возвращает город, число часов и признак «завтра»
+
+    Без названия города используется default_city (None, если он не задан).
+    """
+    city_args, hours, tomorrow = args, FORECAST_DEFAULT_HOURS, False
+    # Единственный аргумент считается городом, если города по умолчанию нет
+    if args and (len(args) > 1 or default_city):
+        if args[-1].casefold() in ('завтра', 'tomorrow'):
+            city_args, hours, tomorrow = args[:-1], None, True
+        elif args[-1].isdigit():
+            city_args, hours = args[:-1], min(max(int(args[-1]), 3), FORECAST_MAX_HOURS)
+    return ' '.join(city_args) or default_city, hours, tomorrow
 
 def forecast(update, context):
     chat_id = update.effective_chat.id
     
-    if not context.args:
-        context.bot.send_message(chat_id=chat_id, text='Пожалуйста, укажите название города. Пример: /forecast Москва')
+    profile = user_profile(update)
+    city, hours, tomorrow = parse_forecast_args(context.args, profile.city)
+    if not city:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('usage_city', profile.lang, profile.units, command='forecast'))
         return
     
-    city = ' '.join(context.args)
+    location = resolve_city(city, profile)
+    if location is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
     
     try:
-        url = f'{Config.OPENWEATHER_BASE_URL}/forecast?q={city}&appid={Config.OPENWEATHER_API_KEY}&units={Config.WEATHER_UNITS}&lang={Config.WEATHER_LANG}'
-        
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        series = forecast_store.get(location, units=profile.units, lang=profile.lang)
         
-        if data.get('cod') != '200':
-            context.bot.send_message(chat_id=chat_id, text=f'Город "{city}" не найден. Проверьте правильность написания.')
+        if series is None:
+            context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
             return
         
-        forecast_data = data['list'][:8]  # Ограничиваем до 8 записей (24 часа)
-        
-        forecast_message = f'Прогноз погоды в городе {city}:\n'
-        for forecast in forecast_data:
-            forecast_time = datetime.fromtimestamp(forecast['dt']).strftime('%Y-%m-%d %H:%M:%S')
-            temperature = int(forecast['main']['temp'])
-            description = forecast['weather'][0]['description']
-            forecast_message += f'{forecast_time}: {temperature}°C, {description}\n'
-        
-        context.bot.send_message(chat_id=chat_id, text=forecast_message)
+        stale = series.is_stale(max_age=forecast_store.max_age)
+        if tomorrow:
+            message = renderer.forecast('forecast_tomorrow', city, series, series.day(1),
+                                        profile.lang, profile.units, stale=stale)
+        else:
+            message = renderer.forecast('forecast_hours', city, series, series.upcoming(hours),
+                                        profile.lang, profile.units, hours=hours, stale=stale)
+        context.bot.send_message(chat_id=chat_id, text=message)
         
     except requests.exceptions.RequestException as e:
         logging.error(f'Ошибка при запросе прогноза: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла ошибка при получении прогноза погоды. Попробуйте позже.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_forecast', profile.lang, profile.units))
     except KeyError as e:
         logging.error(f'Ошибка в структуре данных API: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Получены некорректные данные от сервиса погоды.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_bad_data', profile.lang, profile.units))
     except Exception as e:
         logging.error(f'Неожиданная ошибка: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла неожиданная ошибка.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_unexpected', profile.lang, profile.units))
 
 def sunrise(update, context):
     chat_id = update.effective_chat.id
     
-    if not context.args:
-        context.bot.send_message(chat_id=chat_id, text='Пожалуйста, укажите название города. Пример: /sunrise Москва')
+    profile = user_profile(update)
+    city = ' '.join(context.args) or profile.city
+    if not city:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('usage_city', profile.lang, profile.units, command='sunrise'))
         return
     
-    city = ' '.join(context.args)
+    location = resolve_city(city, profile)
+    if location is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
     
     try:
-        url = f'{Config.OPENWEATHER_BASE_URL}/weather?q={city}&appid={Config.OPENWEATHER_API_KEY}&units={Config.WEATHER_UNITS}&lang={Config.WEATHER_LANG}'
-        
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = weather_client.current(location, units=profile.units, lang=profile.lang)
         
         if data.get('cod') != 200:
-            context.bot.send_message(chat_id=chat_id, text=f'Город "{city}" не найден. Проверьте правильность написания.')
+            context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
             return
         
-        sunrise_time = datetime.fromtimestamp(data['sys']['sunrise']).strftime('%Y-%m-%d %H:%M:%S')
-        
-        message = f'Время восхода солнца в городе {city}:\n'
-        message += f'{sunrise_time}'
+        message = renderer.current('sunrise', city, data, profile.lang, profile.units)
         
         context.bot.send_message(chat_id=chat_id, text=message)
         
     except requests.exceptions.RequestException as e:
         logging.error(f'Ошибка при запросе времени восхода: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла ошибка при получении данных. Попробуйте позже.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_data', profile.lang, profile.units))
     except KeyError as e:
         logging.error(f'Ошибка в структуре данных API: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Получены некорректные данные от сервиса погоды.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_bad_data', profile.lang, profile.units))
     except Exception as e:
         logging.error(f'Неожиданная ошибка: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла неожиданная ошибка.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_unexpected', profile.lang, profile.units))
 
 def sunset(update, context):
     chat_id = update.effective_chat.id
     
-    if not context.args:
-        context.bot.send_message(chat_id=chat_id, text='Пожалуйста, укажите название города. Пример: /sunset Москва')
+    profile = user_profile(update)
+    city = ' '.join(context.args) or profile.city
+    if not city:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('usage_city', profile.lang, profile.units, command='sunset'))
         return
     
-    city = ' '.join(context.args)
+    location = resolve_city(city, profile)
+    if location is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
     
     try:
-        url = f'{Config.OPENWEATHER_BASE_URL}/weather?q={city}&appid={Config.OPENWEATHER_API_KEY}&units={Config.WEATHER_UNITS}&lang={Config.WEATHER_LANG}'
-        
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = weather_client.current(location, units=profile.units, lang=profile.lang)
         
         if data.get('cod') != 200:
-            context.bot.send_message(chat_id=chat_id, text=f'Город "{city}" не найден. Проверьте правильность написания.')
+            context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
             return
         
-        sunset_time = datetime.fromtimestamp(data['sys']['sunset']).strftime('%Y-%m-%d %H:%M:%S')
-        
-        message = f'Время захода солнца в городе {city}:\n'
-        message += f'{sunset_time}'
+        message = renderer.current('sunset', city, data, profile.lang, profile.units)
         
         context.bot.send_message(chat_id=chat_id, text=message)
         
     except requests.exceptions.RequestException as e:
         logging.error(f'Ошибка при запросе времени заката: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла ошибка при получении данных. Попробуйте позже.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_data', profile.lang, profile.units))
     except KeyError as e:
         logging.error(f'Ошибка в структуре данных API: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Получены некорректные данные от сервиса погоды.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_bad_data', profile.lang, profile.units))
     except Exception as e:
         logging.error(f'Неожиданная ошибка: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла неожиданная ошибка.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_unexpected', profile.lang, profile.units))
 
 def humidity(update, context):
     chat_id = update.effective_chat.id
     
-    if not context.args:
-        context.bot.send_message(chat_id=chat_id, text='Пожалуйста, укажите название города. Пример: /humidity Москва')
+    profile = user_profile(update)
+    city = ' '.join(context.args) or profile.city
+    if not city:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('usage_city', profile.lang, profile.units, command='humidity'))
         return
     
-    city = ' '.join(context.args)
+    location = resolve_city(city, profile)
+    if location is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
     
     try:
-        url = f'{Config.OPENWEATHER_BASE_URL}/weather?q={city}&appid={Config.OPENWEATHER_API_KEY}&units={Config.WEATHER_UNITS}&lang={Config.WEATHER_LANG}'
-        
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = weather_client.current(location, units=profile.units, lang=profile.lang)
         
         if data.get('cod') != 200:
-            context.bot.send_message(chat_id=chat_id, text=f'Город "{city}" не найден. Проверьте правильность написания.')
+            context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
             return
         
-        humidity = data['main']['humidity']
-        
-        message = f'Уровень влажности в городе {city}:\n'
-        message += f'{humidity}%'
+        message = renderer.current('humidity', city, data, profile.lang, profile.units)
         
         context.bot.send_message(chat_id=chat_id, text=message)
         
     except requests.exceptions.RequestException as e:
         logging.error(f'Ошибка при запросе влажности: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла ошибка при получении данных. Попробуйте позже.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_data', profile.lang, profile.units))
     except KeyError as e:
         logging.error(f'Ошибка в структуре данных API: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Получены некорректные данные от сервиса погоды.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_bad_data', profile.lang, profile.units))
     except Exception as e:
         logging.error(f'Неожиданная ошибка: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла неожиданная ошибка.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_unexpected', profile.lang, profile.units))
 
 def wind(update, context):
     chat_id = update.effective_chat.id
     
-    if not context.args:
-        context.bot.send_message(chat_id=chat_id, text='Пожалуйста, укажите название города. Пример: /wind Москва')
+    profile = user_profile(update)
+    city = ' '.join(context.args) or profile.city
+    if not city:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('usage_city', profile.lang, profile.units, command='wind'))
         return
     
-    city = ' '.join(context.args)
+    location = resolve_city(city, profile)
+    if location is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
     
     try:
-        url = f'{Config.OPENWEATHER_BASE_URL}/weather?q={city}&appid={Config.OPENWEATHER_API_KEY}&units={Config.WEATHER_UNITS}&lang={Config.WEATHER_LANG}'
-        
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = weather_client.current(location, units=profile.units, lang=profile.lang)
         
         if data.get('cod') != 200:
-            context.bot.send_message(chat_id=chat_id, text=f'Город "{city}" не найден. Проверьте правильность написания.')
+            context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
             return
         
-        wind_speed = data['wind']['speed']
-        wind_direction = data['wind'].get('deg', 'неизвестно')
-        
-        message = f'Скорость ветра в городе {city}:\n'
-        message += f'{wind_speed} м/с, направление: {wind_direction}°'
+        message = renderer.current('wind', city, data, profile.lang, profile.units)
         
         context.bot.send_message(chat_id=chat_id, text=message)
         
     except requests.exceptions.RequestException as e:
         logging.error(f'Ошибка при запросе данных о ветре: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла ошибка при получении данных. Попробуйте позже.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_data', profile.lang, profile.units))
     except KeyError as e:
         logging.error(f'Ошибка в структуре данных API: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Получены некорректные данные от сервиса погоды.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_bad_data', profile.lang, profile.units))
     except Exception as e:
         logging.error(f'Неожиданная ошибка: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла неожиданная ошибка.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_unexpected', profile.lang, profile.units))
 
 def pressure(update, context):
     chat_id = update.effective_chat.id
     
-    if not context.args:
-        context.bot.send_message(chat_id=chat_id, text='Пожалуйста, укажите название города. Пример: /pressure Москва')
+    profile = user_profile(update)
+    city = ' '.join(context.args) or profile.city
+    if not city:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('usage_city', profile.lang, profile.units, command='pressure'))
         return
     
-    city = ' '.join(context.args)
+    location = resolve_city(city, profile)
+    if location is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
     
     try:
-        url = f'{Config.OPENWEATHER_BASE_URL}/weather?q={city}&appid={Config.OPENWEATHER_API_KEY}&units={Config.WEATHER_UNITS}&lang={Config.WEATHER_LANG}'
-        
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = weather_client.current(location, units=profile.units, lang=profile.lang)
         
         if data.get('cod') != 200:
-            context.bot.send_message(chat_id=chat_id, text=f'Город "{city}" не найден. Проверьте правильность написания.')
+            context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
             return
         
-        pressure = data['main']['pressure']
-        
-        message = f'Атмосферное давление в городе {city}:\n'
-        message += f'{pressure} гПа'
+        message = renderer.current('pressure', city, data, profile.lang, profile.units)
         
         context.bot.send_message(chat_id=chat_id, text=message)
         
     except requests.exceptions.RequestException as e:
         logging.error(f'Ошибка при запросе давления: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла ошибка при получении данных. Попробуйте позже.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_data', profile.lang, profile.units))
+    except KeyError as e:
+        logging.error(f'Ошибка в структуре данных API: {e}')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_bad_data', profile.lang, profile.units))
+    except Exception as e:
+        logging.error(f'Неожиданная ошибка: {e}')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_unexpected', profile.lang, profile.units))
+
+def compare(update, context):
+    chat_id = update.effective_chat.id
+    profile = user_profile(update)
+    
+    cities = [city.strip() for city in ' '.join(context.args).split(',') if city.strip()]
+    if len(cities) < 2:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('usage_compare', profile.lang, profile.units))
+        return
+    if len(cities) > Config.COMPARE_MAX_CITIES:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('compare_too_many', profile.lang, profile.units, limit=Config.COMPARE_MAX_CITIES))
+        return
+    
+    locations = [resolve_city(city, profile) for city in cities]
+    not_found = [city for city, location in zip(cities, locations) if location is None]
+    if not_found:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('compare_missing', profile.lang, profile.units, cities=', '.join(not_found)))
+        return
+    
+    try:
+        results = weather_client.current_many(locations, units=profile.units, lang=profile.lang)
+        
+        errors = [data for data in results if isinstance(data, Exception)]
+        if errors:
+            logging.error(f'Ошибка при запросе погоды для сравнения ({len(errors)} городов): {errors[0]}')
+        rows = [(city, None if isinstance(data, Exception) else data) for city, data in zip(cities, results)]
+        stale = any(data.get('stale') for _, data in rows if data is not None)
+        
+        message = renderer.comparison(rows, profile.lang, profile.units, stale=stale)
+        
+        context.bot.send_message(chat_id=chat_id, text=message, parse_mode=telegram.ParseMode.HTML)
+        
     except KeyError as e:
         logging.error(f'Ошибка в структуре данных API: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Получены некорректные данные от сервиса погоды.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_bad_data', profile.lang, profile.units))
     except Exception as e:
         logging.error(f'Неожиданная ошибка: {e}')
-        context.bot.send_message(chat_id=chat_id, text='Произошла неожиданная ошибка.')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_unexpected', profile.lang, profile.units))
+
+def fetch_subscription_forecast(city):
+    location = resolve_city(city)
+    if location is None:
+        return None
+    return forecast_store.get(location)
+
+def render_subscription_forecast(city, series):
+    if series is None:
+        return None
+    return renderer.forecast('forecast_daily', city, series, series.upcoming(FORECAST_DEFAULT_HOURS),
+                             Config.WEATHER_LANG, Config.WEATHER_UNITS)
+
+def subscribe(update, context):
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    profile = user_profile(update)
+    
+    match = TIME_PATTERN.match(context.args[-1]) if context.args else None
+    if len(context.args) < 2 or match is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('usage_subscribe', profile.lang, profile.units))
+        return
+    
+    city = ' '.join(context.args[:-1])
+    send_time = f'{int(match.group(1)):02d}:{match.group(2)}'
+    location = resolve_city(city)
+    if location is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
+    
+    try:
+        # Время подписки - местное время города; его часовой пояс берем из прогноза
+        series = forecast_store.get(location)
+    except requests.exceptions.RequestException as e:
+        logging.error(f'Ошибка при запросе прогноза для подписки: {e}')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_timezone', profile.lang, profile.units))
+        return
+    if series is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
+    
+    try:
+        subscription_store.subscribe(user_id, chat_id, city, city_key(location), send_time, series.timezone)
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('subscribed', profile.lang, profile.units, city=city,
+                                                                     time=send_time, tz=city_timezone(series.timezone)))
+    except sqlite3.Error as e:
+        logging.error(f'Ошибка при сохранении подписки: {e}')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_subscribe', profile.lang, profile.units))
+
+def unsubscribe(update, context):
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    profile = user_profile(update)
+    
+    city = ' '.join(context.args)
+    try:
+        if city:
+            location = resolve_city(city)
+            removed = subscription_store.unsubscribe(user_id, city_key(location)) if location is not None else 0
+        else:
+            removed = subscription_store.unsubscribe(user_id)
+    except sqlite3.Error as e:
+        logging.error(f'Ошибка при удалении подписки: {e}')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_unsubscribe', profile.lang, profile.units))
+        return
+    
+    if removed:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('unsubscribed', profile.lang, profile.units))
+    else:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('no_subscription', profile.lang, profile.units))
+
+def setcity(update, context):
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    profile = user_profile(update)
+    
+    city = ' '.join(context.args)
+    if not city:
+        kind = 'settings_city' if profile.city else 'settings_no_city'
+        context.bot.send_message(chat_id=chat_id, text=renderer.text(kind, profile.lang, profile.units, city=profile.city))
+        return
+    
+    location = resolve_city(city, profile)
+    if location is None:
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+        return
+    
+    try:
+        # Без локального индекса название проверяется запросом к API; ответ заодно попадает в кэш
+        if not isinstance(location, City):
+            data = weather_client.current(location, units=profile.units, lang=profile.lang)
+            if data.get('cod') != 200:
+                context.bot.send_message(chat_id=chat_id, text=renderer.text('not_found', profile.lang, profile.units, city=city))
+                return
+        
+        profile_store.update(user_id, city=city)
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('settings_city', profile.lang, profile.units, city=city))
+        
+    except requests.exceptions.RequestException as e:
+        logging.error(f'Ошибка при проверке города: {e}')
+        context.bot.send_message(chat_id=chat_id, text=renderer.text('error_city_check', profile.lang, profile.units))
+
+def units(update, context):
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    profile = user_profile(update)
+    choices = ', '.join(ProfileStore.UNITS)
+    
+    if context.args:
+        value = context.args[0].casefold()
+        if value not in ProfileStore.UNITS:
+            context.bot.send_message(chat_id=chat_id, text=renderer.text('settings_invalid', profile.lang, profile.units,
+                                                                         value=context.args[0], choices=choices))
+            return
+        profile_store.update(user_id, units=value)
+        profile = profile._replace(units=value)
+    
+    context.bot.send_message(chat_id=chat_id, text=renderer.text('settings_units', profile.lang, profile.units,
+                                                                 name=profile.units, choices=choices))
+
+def lang(update, context):
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    profile = user_profile(update)
+    choices = ', '.join(LANGUAGES)
+    
+    if context.args:
+        value = context.args[0].casefold()
+        if value not in LANGUAGES:
+            context.bot.send_message(chat_id=chat_id, text=renderer.text('settings_invalid', profile.lang, profile.units,
+                                                                         value=context.args[0], choices=choices))
+            return
+        profile_store.update(user_id, lang=value)
+        profile = profile._replace(lang=value)
+    
+    context.bot.send_message(chat_id=chat_id, text=renderer.text('settings_lang', profile.lang, profile.units,
+                                                                 name=profile.lang, choices=choices))
 
 def help(update, context):
     chat_id = update.effective_chat.id
-    message = '''Доступные команды:
-/weather <город> - получить текущую погоду в заданном городе.
-/forecast <город> - получить прогноз погоды в заданном городе.
-/sunrise <город> - получить время восхода солнца в заданном городе.
-/sunset <город> - получить время захода солнца в заданном городе.
-/humidity <город> - получить уровень влажности в заданном городе.
-/wind <город> - получить текущую скорость ветра в заданном городе.
-/pressure <город> - получить текущее атмосферное давление в заданном городе.
-/help - получить справку и список доступных команд.'''
-    context.bot.send_message(chat_id=chat_id, text=message)
+    profile = user_profile(update)
+    context.bot.send_message(chat_id=chat_id, text=renderer.text('help', profile.lang, profile.units))
 
 def error(update, context):
     chat_id = update.effective_chat.id
-    message = 'Неправильный формат команды. Введите /help, чтобы получить список доступных команд.'
-    context.bot.send_message(chat_id=chat_id, text=message)
+    profile = user_profile(update)
+    context.bot.send_message(chat_id=chat_id, text=renderer.text('error_command', profile.lang, profile.units))
 
-def main():
-    # Настройка логирования
+COMMANDS = [
+    ('start', start),
+    ('weather', weather),
+    ('forecast', forecast),
+    ('sunrise', sunrise),
+    ('sunset', sunset),
+    ('humidity', humidity),
+    ('wind', wind),
+    ('pressure', pressure),
+    ('compare', compare),
+    ('subscribe', subscribe),
+    ('unsubscribe', unsubscribe),
+    ('setcity', setcity),
+    ('units', units),
+    ('lang', lang),
+    ('help', help),
+]
+
+def register_handlers(dispatcher):
+    """Добавляет обработчики команд, каждый обернут сбором метрик, и обработчик ошибок"""
+    for command, callback in COMMANDS:
+        dispatcher.add_handler(CommandHandler(command, metrics.instrument(command, callback)))
+    dispatcher.add_error_handler(error)
+
+def register_runtime_metrics(update_queue_depth):
+    metrics.registry.gauge('bot_update_queue_depth', 'Обновления, ожидающие обработки',
+                           update_queue_depth)
+    metrics.registry.gauge('weather_cache_size', 'Записей в кэше текущей погоды',
+                           lambda: weather_cache.stats()['size'])
+    metrics.registry.callback_counter('weather_cache_hits_total', 'Попадания в кэш текущей погоды',
+                                      lambda: weather_cache.stats()['hits'])
+    metrics.registry.callback_counter('weather_cache_misses_total', 'Промахи кэша текущей погоды',
+                                      lambda: weather_cache.stats()['misses'])
+    metrics.registry.callback_counter('weather_cache_evictions_total', 'Вытеснения из кэша текущей погоды',
+                                      lambda: weather_cache.stats()['evictions'])
+    if cache_backend is not None:
+        metrics.registry.callback_counter('cache_backend_hits_total', 'Попадания в общий кэш',
+                                          lambda: cache_backend.stats()['hits'])
+        metrics.registry.callback_counter('cache_backend_misses_total', 'Промахи общего кэша',
+                                          lambda: cache_backend.stats()['misses'])
+    metrics.registry.gauge('user_profiles_cached', 'Настройки пользователей в памяти',
+                           lambda: profile_store.stats()['size'])
+    metrics.registry.gauge('user_profiles_pending', 'Измененные настройки пользователей, ожидающие записи в базу',
+                           lambda: profile_store.stats()['pending'])
+    if refresher is not None:
+        metrics.registry.gauge('refresher_tracked_cities', 'Города, популярность которых отслеживается для фонового обновления',
+                               lambda: len(refresher.counter))
+    metrics.registry.gauge('owm_circuit_open', 'Circuit breaker OpenWeatherMap разомкнут (1) или замкнут (0)',
+                           lambda: int(upstream_guard.breaker.state != CircuitBreaker.CLOSED))
+    metrics.registry.callback_counter('owm_coalesced_requests_total', 'Запросы, схлопнутые с уже выполняющимися',
+                                      lambda: weather_client.stats()['coalesced'])
+
+def create_bot(threads):
+    """Bot с замером времени send_message; пул соединений рассчитан на все потоки обработки"""
+    return metrics.InstrumentedBot(
+        token=Config.TELEGRAM_BOT_TOKEN,
+        request=Request(con_pool_size=threads + 4),
+    )
+
+def open_resources():
+    """Загружает индекс городов и открывает хранилища; вызывается в каждом процессе после setup_components()"""
+    global city_index
+    city_index = load_city_index(config.CITY_LIST_PATH)
+    user_store.open()
+    subscription_store.open()
+    profile_store.open()
+
+def close_resources():
+    if refresher is not None:
+        refresher.stop()
+    weather_client.close()
+    user_store.close()
+    profile_store.close()
+    database.close()
+    if cache_backend is not None:
+        cache_backend.close()
+
+def warm_up_cache():
+    """Заранее загружает погоду и прогноз популярных городов, чтобы после запуска не начинать с всплеска запросов к API"""
+    cities = [location for location in map(resolve_city, Config.CACHE_WARMUP_CITIES) if location is not None]
+    cities += weather_client.popular_cities(Config.CACHE_WARMUP_SIZE)
+    cities = list({weather_client.location_key(city): city for city in cities}.values())
+    if not cities:
+        return
+    
+    started = time.monotonic()
+    weather_client.current_many(cities)
+    for city in cities:
+        try:
+            forecast_store.get(city)
+        except UpstreamUnavailableError as e:
+            # Лимит запросов нужнее пользователям: остальные прогнозы загрузятся по первому запросу
+            logging.warning(f'Прогрев кэша прерван: {e}')
+            break
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'Ошибка при прогреве прогноза: {e}')
+    logging.info(f'Кэш прогрет: {len(cities)} городов за {time.monotonic() - started:.1f} с')
+
+def setup_logging():
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         level=logging.INFO
     )
+
+def setup_webhook_worker(index, threads):
+    """Готовит процесс-воркер webhook: свои кэши, соединения и Dispatcher с обработчиками бота"""
+    setup_logging()
+    setup_components()
+    open_resources()
+    dispatcher = Dispatcher(create_bot(threads), queue.Queue(), workers=threads, use_context=True)
+    register_handlers(dispatcher)
+    register_runtime_metrics(lambda: 0)
+    # Метрики воркеров отдаются на следующих за METRICS_PORT портах
+    if Config.METRICS_PORT:
+        metrics.start_http_server(Config.METRICS_PORT + 1 + index, Config.METRICS_HOST)
+    # Популярные города у каждого воркера свои: он обновляет то, что спрашивают в его шардах
+    if refresher is not None:
+        refresher.start()
+    return dispatcher, close_resources
+
+def run_polling(bot):
+    updater = Updater(bot=bot, workers=Config.BOT_WORKERS, use_context=True)
+    register_handlers(updater.dispatcher)
+    register_runtime_metrics(updater.dispatcher.update_queue.qsize)
+    if Config.METRICS_PORT:
+        metrics.start_http_server(Config.METRICS_PORT, Config.METRICS_HOST)
+    
+    if refresher is not None:
+        refresher.start()
+    
+    logging.info('Бот запущен и готов к работе!')
+    updater.start_polling()
+    updater.idle()
+
+def run_webhook(bot):
+    """Принимает обновления по webhook и обрабатывает их в WEBHOOK_PROCESSES процессах"""
+    pool = WebhookPool(setup_webhook_worker, processes=Config.WEBHOOK_PROCESSES,
+                       threads=Config.BOT_WORKERS, queue_size=Config.WEBHOOK_QUEUE_SIZE)
+    register_runtime_metrics(pool.qsize)
+    if Config.METRICS_PORT:
+        metrics.start_http_server(Config.METRICS_PORT, Config.METRICS_HOST)
+    
+    pool.start(Config.WEBHOOK_LISTEN, Config.WEBHOOK_PORT, urlsplit(Config.WEBHOOK_URL).path or '/',
+               Config.WEBHOOK_SECRET)
+    try:
+        api_kwargs = {'secret_token': Config.WEBHOOK_SECRET} if Config.WEBHOOK_SECRET else None
+        bot.set_webhook(url=Config.WEBHOOK_URL, max_connections=Config.WEBHOOK_MAX_CONNECTIONS,
+                        api_kwargs=api_kwargs)
+        logging.info('Бот запущен в режиме webhook и готов к работе!')
+        pool.wait()
+    finally:
+        logging.info('Остановка: дообрабатываем принятые обновления')
+        pool.stop(Config.WEBHOOK_DRAIN_TIMEOUT)
+
+def main():
+    # Настройка логирования
+    setup_logging()
     
     try:
         # Проверяем конфигурацию
         Config.validate_config()
         
-        updater = Updater(token=Config.TELEGRAM_BOT_TOKEN, use_context=True)
-        dispatcher = updater.dispatcher
+        setup_components()
+        open_resources()
+        bot = create_bot(Config.BOT_WORKERS)
+        
+        # Рассылка подписок идет в своих потоках главного процесса и не занимает обработчики команд
+        send_queue = SendQueue(bot, rate=Config.TELEGRAM_SEND_RATE)
+        subscription_scheduler = SubscriptionScheduler(
+            subscription_store,
+            fetch=fetch_subscription_forecast,
+            render=render_subscription_forecast,
+            send_queue=send_queue,
+            fetch_workers=Config.SUBSCRIPTIONS_FETCH_WORKERS,
+        )
+        metrics.registry.gauge('subscription_send_queue_depth', 'Сообщения подписок в очереди на отправку',
+                               send_queue.qsize)
         
-        # Добавляем обработчики команд
-        dispatcher.add_handler(CommandHandler('start', start))
-        dispatcher.add_handler(CommandHandler('weather', weather))
-        dispatcher.add_handler(CommandHandler('forecast', forecast))
-        dispatcher.add_handler(CommandHandler('sunrise', sunrise))
-        dispatcher.add_handler(CommandHandler('sunset', sunset))
-        dispatcher.add_handler(CommandHandler('humidity', humidity))
-        dispatcher.add_handler(CommandHandler('wind', wind))
-        dispatcher.add_handler(CommandHandler('pressure', pressure))
-        dispatcher.add_handler(CommandHandler('help', help))
+        send_queue.start()
+        subscription_scheduler.start()
+        # В режиме webhook главный процесс не обслуживает команды: прогрев имеет смысл,
+        # только если он наполняет общий кэш, из которого читают воркеры
+        if Config.BOT_MODE != 'webhook' or cache_backend is not None:
+            threading.Thread(target=warm_up_cache, name='cache-warmup', daemon=True).start()
         
-        # Добавляем обработчик ошибок
-        dispatcher.add_error_handler(error)
+        if Config.BOT_MODE == 'webhook':
+            run_webhook(bot)
+        else:
+            run_polling(bot)
         
-        logging.info('Бот запущен и готов к работе!')
-        updater.start_polling()
-        updater.idle()
+        subscription_scheduler.stop()
+        send_queue.stop(Config.SEND_QUEUE_DRAIN_TIMEOUT)
+        close_resources()
         
     except ValueError as e:
         logging.error(f'Ошибка конфигурации: {e}')
@@ -372,9 +826,8 @@ def main():
 
 if __name__ == '__main__':
     try:
-        create_users_table()
         main()
     except KeyboardInterrupt:
         logging.info('Бот остановлен пользователем')
     except Exception as e:
-        logging.error(f'Неожиданная ошибка: {e}')
\ No newline at end of file
+        logging.error(f'Неожиданная ошибка: {e}')
@@ -0,0 +1,503 @@
+"""Нагрузочный тест обработчиков бота без доступа к сети
+
+Поднимает локальный фейковый сервер OpenWeatherMap и подменяет context.bot,
+после чего прогоняет настоящие обработчики из OpenWeatherMap.py так же,
+как это делают потоки Dispatcher.
+
+Пример:
+    python benchmark.py --users 200 --requests 5000 --latency-ms 80 --error-rate 0.01
+    python benchmark.py --json --max-p99-ms 500 --max-upstream-calls 300
+"""
+
+import argparse
+import bisect
+import copy
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from config import Config
+
+CITIES = [
+    'Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург', 'Казань', 'Нижний Новгород',
+    'Челябинск', 'Самара', 'Омск', 'Ростов-на-Дону', 'Уфа', 'Красноярск', 'Воронеж', 'Пермь',
+    'Волгоград', 'Краснодар', 'Саратов', 'Тюмень', 'Тольятти', 'Ижевск', 'Барнаул', 'Ульяновск',
+    'Иркутск', 'Хабаровск', 'Ярославль', 'Владивосток', 'Махачкала', 'Томск', 'Оренбург',
+    'Кемерово', 'Новокузнецк', 'Рязань', 'Астрахань', 'Набережные Челны', 'Пенза', 'Липецк',
+    'Киров', 'Чебоксары', 'Тула', 'Калининград', 'Курск', 'Сочи', 'Ставрополь', 'Тверь',
+    'Магнитогорск', 'Иваново', 'Брянск', 'Белгород', 'Сургут', 'Владимир',
+]
+
+# Доля команд в нагрузке; значения взяты из типичного распределения запросов к боту
+COMMAND_MIX = {
+    'weather': 40,
+    'forecast': 20,
+    'humidity': 8,
+    'wind': 8,
+    'pressure': 6,
+    'sunrise': 6,
+    'sunset': 6,
+    'compare': 2,
+    'start': 4,
+    'help': 2,
+}
+
+# Записанные ответы OpenWeatherMap, поля которых подставляются для каждого города
+WEATHER_RESPONSE = {
+    'coord': {'lon': 37.6156, 'lat': 55.7522},
+    'weather': [{'id': 804, 'main': 'Clouds', 'description': 'пасмурно', 'icon': '04d'}],
+    'base': 'stations',
+    'main': {'temp': 3.41, 'feels_like': -0.62, 'temp_min': 2.62, 'temp_max': 4.19,
+             'pressure': 1017, 'humidity': 81, 'sea_level': 1017, 'grnd_level': 999},
+    'visibility': 10000,
+    'wind': {'speed': 4.9, 'deg': 242, 'gust': 11.3},
+    'clouds': {'all': 100},
+    'dt': 1700046000,
+    'sys': {'type': 2, 'id': 2000314, 'country': 'RU', 'sunrise': 1700024461, 'sunset': 1700054502},
+    'timezone': 10800,
+    'id': 524901,
+    'name': 'Москва',
+    'cod': 200,
+}
+
+FORECAST_ITEM = {
+    'dt': 1700049600,
+    'main': {'temp': 3.12, 'feels_like': -0.9, 'temp_min': 2.8, 'temp_max': 3.12,
+             'pressure': 1017, 'humidity': 82},
+    'weather': [{'id': 804, 'main': 'Clouds', 'description': 'пасмурно', 'icon': '04d'}],
+    'clouds': {'all': 100},
+    'wind': {'speed': 4.6, 'deg': 240, 'gust': 10.8},
+    'visibility': 10000,
+    'pop': 0.08,
+    'dt_txt': '2023-11-15 12:00:00',
+}
+
+FORECAST_DESCRIPTIONS = ['пасмурно', 'небольшой дождь', 'облачно с прояснениями', 'ясно']
+
+# Команды, которые без названия города используют город по умолчанию пользователя
+DEFAULT_CITY_COMMANDS = {'weather', 'forecast', 'humidity', 'wind', 'pressure', 'sunrise', 'sunset'}
+
+
+def _city_payloads(index, name, now):
+    weather = copy.deepcopy(WEATHER_RESPONSE)
+    weather['dt'] = int(now)
+    weather['id'] = 1000 + index
+    weather['name'] = name
+    weather['main']['temp'] = round(-10 + index * 0.7, 2)
+
+    items = []
+    for step in range(40):
+        item = copy.deepcopy(FORECAST_ITEM)
+        # Как и в OpenWeatherMap, ряд начинается со следующего трехчасового интервала
+        item['dt'] = (int(now) // 10800 + 1 + step) * 10800
+        item['dt_txt'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(item['dt']))
+        item['main']['temp'] = round(weather['main']['temp'] + (step % 8) - 4, 2)
+        item['weather'][0]['description'] = FORECAST_DESCRIPTIONS[(index + step) % len(FORECAST_DESCRIPTIONS)]
+        items.append(item)
+    forecast = {
+        'cod': '200', 'message': 0, 'cnt': len(items), 'list': items,
+        'city': {'id': weather['id'], 'name': name, 'coord': weather['coord'], 'country': 'RU',
+                 'timezone': weather['timezone'], 'sunrise': weather['sys']['sunrise'],
+                 'sunset': weather['sys']['sunset']},
+    }
+    return weather, forecast
+
+
+def write_city_list(path, cities):
+    """Записывает city.list.json в формате OpenWeatherMap с теми же id, что у FakeOpenWeatherMap"""
+    city_list = [{'id': 1000 + index, 'name': name, 'state': '', 'country': 'RU',
+                  'coord': WEATHER_RESPONSE['coord']} for index, name in enumerate(cities)]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(city_list, f, ensure_ascii=False)
+
+
+class FakeOpenWeatherMap:
+    """Локальный HTTP-сервер, отвечающий записанными данными OpenWeatherMap"""
+
+    def __init__(self, cities, latency_ms=50.0, jitter_ms=10.0, error_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self.calls = {}
+        self._calls_lock = threading.Lock()
+
+        self.by_name = {}
+        self.by_id = {}
+        now = time.time()
+        for index, name in enumerate(cities):
+            payloads = _city_payloads(index, name, now)
+            encoded = tuple(json.dumps(payload, ensure_ascii=False).encode('utf-8') for payload in payloads)
+            self.by_name[' '.join(name.split()).casefold()] = encoded
+            self.by_id[payloads[0]['id']] = encoded
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    @property
+    def total_calls(self):
+        with self._calls_lock:
+            return sum(self.calls.values())
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request):
+        url = urlparse(request.path)
+        query = parse_qs(url.query)
+        endpoint = url.path.rsplit('/', 1)[-1]
+        with self._calls_lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+        with self._random_lock:
+            delay = max(self._random.gauss(self.latency_ms, self.jitter_ms), 0) / 1000
+            failed = self._random.random() < self.error_rate
+        time.sleep(delay)
+
+        if failed:
+            return self._reply(request, 500, {'cod': 500, 'message': 'internal error'})
+
+        if endpoint in ('weather', 'forecast'):
+            payloads = self._lookup(query)
+            if payloads is None:
+                return self._reply(request, 404, {'cod': '404', 'message': 'city not found'})
+            return self._reply(request, 200, payloads[0 if endpoint == 'weather' else 1])
+        if endpoint == 'group':
+            ids = [int(value) for value in query.get('id', [''])[0].split(',') if value]
+            items = [self._group_item(json.loads(self.by_id[city_id][0])) for city_id in ids if city_id in self.by_id]
+            return self._reply(request, 200, {'cnt': len(items), 'list': items})
+        return self._reply(request, 404, {'cod': '404', 'message': 'unknown endpoint'})
+
+    @staticmethod
+    def _group_item(payload):
+        """Элемент ответа /group: как /weather, но без cod, а часовой пояс - в sys"""
+        payload.pop('cod', None)
+        payload['sys']['timezone'] = payload.pop('timezone')
+        return payload
+
+    def _lookup(self, query):
+        if 'id' in query:
+            return self.by_id.get(int(query['id'][0]))
+        if 'q' in query:
+            return self.by_name.get(' '.join(query['q'][0].split()).casefold())
+        return None
+
+    @staticmethod
+    def _reply(request, status, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json; charset=utf-8')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+class FakeBot:
+    """Заменитель context.bot: запоминает число отправленных сообщений"""
+
+    def __init__(self, send_latency_ms=0.0):
+        self.send_latency_ms = send_latency_ms
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self.send_latency_ms:
+            time.sleep(self.send_latency_ms / 1000)
+        with self._lock:
+            self.sent += 1
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+
+def _zipf_weights(count, skew):
+    return [1 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def generate_profiles(users, cities, skew, share, seed=0):
+    """Города по умолчанию для доли share пользователей: {пользователь: город}"""
+    rng = random.Random(seed + 1)
+    city_cum = list(itertools.accumulate(_zipf_weights(len(cities), skew)))
+    return {user_id: cities[bisect.bisect(city_cum, rng.random() * city_cum[-1])]
+            for user_id in range(1, users + 1) if rng.random() < share}
+
+
+def generate_workload(requests_count, users, cities, skew, seed=0, profiles=None):
+    """Последовательность (пользователь, команда, аргументы) с популярными городами во главе
+
+    Пользователи из profiles спрашивают о своем городе по умолчанию командами без аргументов.
+    """
+    profiles = profiles or {}
+    rng = random.Random(seed)
+    commands = list(COMMAND_MIX)
+    command_cum = list(itertools.accumulate(COMMAND_MIX.values()))
+    city_cum = list(itertools.accumulate(_zipf_weights(len(cities), skew)))
+
+    workload = []
+    for _ in range(requests_count):
+        user_id = rng.randrange(users) + 1
+        command = commands[bisect.bisect(command_cum, rng.random() * command_cum[-1])]
+        picked = [cities[bisect.bisect(city_cum, rng.random() * city_cum[-1])]
+                  for _ in range(3 if command == 'compare' else 1)]
+        if command in ('start', 'help') or (user_id in profiles and command in DEFAULT_CITY_COMMANDS):
+            args = []
+        else:
+            args = ', '.join(picked).split()
+        workload.append((user_id, command, args))
+    return workload
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(percent / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class HandlerRegistry:
+    """Принимает обработчики вместо Dispatcher и запоминает их по командам"""
+
+    def __init__(self):
+        self.callbacks = {}
+        self.error_handlers = []
+
+    def add_handler(self, handler):
+        for command in handler.command:
+            self.callbacks[command] = handler.callback
+
+    def add_error_handler(self, callback):
+        self.error_handlers.append(callback)
+
+
+def run_benchmark(users=100, requests_count=2000, workers=None, latency_ms=50.0, jitter_ms=10.0,
+                  error_rate=0.0, skew=1.1, send_latency_ms=0.0, calls_per_minute=6000.0, seed=0,
+                  cache_backend_url=None, cache_ttl=None, refresh=False, rate=None, profile_share=0.0):
+    """Прогоняет нагрузку через обработчики бота и возвращает отчет в виде словаря"""
+    import OpenWeatherMap as bot_module
+    from storage import Database, ProfileStore
+
+    workers = workers or Config.BOT_WORKERS
+    cache_ttl = cache_ttl or Config.WEATHER_CACHE_TTL
+    fake_api = FakeOpenWeatherMap(CITIES, latency_ms, jitter_ms, error_rate, seed).start()
+    fake_bot = FakeBot(send_latency_ms)
+    db_dir = tempfile.mkdtemp(prefix='owm-bench-')
+
+    # С индексом городов бот запрашивает API по id и пачками /group, как в работе
+    city_list_path = os.path.join(db_dir, 'city.list.json')
+    write_city_list(city_list_path, CITIES)
+    database_path = os.path.join(db_dir, 'users.db')
+
+    # Настройки пользователей записываются в базу заранее: бот загружает их лениво, как после перезапуска.
+    # Каждый второй пользователь с настройками выбрал imperial и en: это отдельные записи кэша
+    profiles = generate_profiles(users, CITIES, skew, profile_share, seed)
+    database = Database(database_path)
+    seed_store = ProfileStore(database)
+    seed_store.open()
+    for user_id, city in profiles.items():
+        if user_id % 2:
+            seed_store.update(user_id, city=city, units='imperial', lang='en')
+        else:
+            seed_store.update(user_id, city=city)
+    seed_store.close()
+    database.close()
+
+    class Settings(Config):
+        """Настройки бота для теста: локальный API и временная база, остальное как в работе"""
+        OPENWEATHER_BASE_URL = fake_api.base_url
+        OPENWEATHER_API_KEY = 'benchmark'
+        OPENWEATHER_CALLS_PER_MINUTE = calls_per_minute
+        DATABASE_NAME = database_path
+        CITY_LIST_PATH = city_list_path
+        CACHE_BACKEND_URL = cache_backend_url
+        WEATHER_CACHE_TTL = cache_ttl
+        BOT_MODE = 'polling'
+        REFRESH_QUOTA_SHARE = Config.REFRESH_QUOTA_SHARE if refresh else 0
+        # Тест короче TTL по умолчанию: обновление должно успевать до истечения записей
+        REFRESH_LEAD = min(Config.REFRESH_LEAD, cache_ttl / 3)
+        REFRESH_INTERVAL = min(Config.REFRESH_INTERVAL, cache_ttl / 3)
+        REFRESH_FORECAST_GAP = min(Config.REFRESH_FORECAST_GAP, cache_ttl)
+
+    # Бот собирается той же фабрикой и с теми же обертками метрик, что и в работе
+    bot_module.setup_components(Settings)
+    bot_module.open_resources()
+    bot_module.register_runtime_metrics(lambda: 0)
+    if bot_module.refresher is not None:
+        bot_module.refresher.start()
+    dispatcher = HandlerRegistry()
+    bot_module.register_handlers(dispatcher)
+    handlers = {command: dispatcher.callbacks[command] for command in COMMAND_MIX}
+
+    workload = generate_workload(requests_count, users, CITIES, skew, seed, profiles)
+    latencies = {command: [] for command in COMMAND_MIX}
+    latencies_lock = threading.Lock()
+
+    def handle(item):
+        user_id, command, args = item
+        update = SimpleNamespace(
+            effective_chat=SimpleNamespace(id=user_id),
+            effective_user=SimpleNamespace(id=user_id, username=f'user{user_id}'),
+        )
+        context = SimpleNamespace(args=args, bot=fake_bot)
+        started = time.perf_counter()
+        handlers[command](update, context)
+        elapsed = time.perf_counter() - started
+        with latencies_lock:
+            latencies[command].append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dispatcher') as pool:
+        if rate:
+            # Команды приходят с постоянной частотой, как от живых пользователей
+            futures = []
+            for i, item in enumerate(workload):
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(pool.submit(handle, item))
+            for future in futures:
+                future.result()
+        else:
+            list(pool.map(handle, workload))
+    duration = time.perf_counter() - started
+
+    profiles_stats = bot_module.profile_store.stats()
+    bot_module.close_resources()
+    fake_api.stop()
+    bot_module.city_index = None
+    shutil.rmtree(db_dir, ignore_errors=True)
+
+    def summary(values):
+        values = sorted(values)
+        return {
+            'count': len(values),
+            'p50_ms': round(_percentile(values, 50) * 1000, 3),
+            'p95_ms': round(_percentile(values, 95) * 1000, 3),
+            'p99_ms': round(_percentile(values, 99) * 1000, 3),
+        }
+
+    # ru_maxrss в Linux измеряется в килобайтах, в macOS - в байтах
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    max_rss_mb = max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+    all_latencies = list(itertools.chain.from_iterable(latencies.values()))
+    return {
+        'requests': len(workload),
+        'users': users,
+        'workers': workers,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(workload) / duration, 1) if duration else 0.0,
+        'latency': summary(all_latencies),
+        'commands': {command: summary(values) for command, values in latencies.items() if values},
+        'upstream_calls': dict(fake_api.calls, total=fake_api.total_calls),
+        'messages_sent': fake_bot.sent,
+        'client': bot_module.weather_client.stats(),
+        'forecast_store': bot_module.forecast_store.stats(),
+        'renderer': bot_module.renderer.stats(),
+        'profiles': profiles_stats,
+        'max_rss_mb': round(max_rss_mb, 1),
+    }
+
+
+def format_report(report):
+    latency = report['latency']
+    lines = [
+        f"Запросов: {report['requests']}, пользователей: {report['users']}, потоков: {report['workers']}",
+        f"Длительность: {report['duration_s']} с, пропускная способность: {report['throughput_rps']} запр/с",
+        f"Задержка: p50 {latency['p50_ms']} мс, p95 {latency['p95_ms']} мс, p99 {latency['p99_ms']} мс",
+        f"Запросов к API: {report['upstream_calls']['total']} {report['upstream_calls']}",
+        f"Отправлено сообщений: {report['messages_sent']}",
+        f"Клиент: {report['client']}",
+        f"Хранилище прогнозов: {report['forecast_store']}",
+        f"Готовые ответы: {report['renderer']}",
+        f"Настройки пользователей: {report['profiles']}",
+        f"Пиковая память: {report['max_rss_mb']} МБ",
+        '',
+        f"{'Команда':<10} {'кол-во':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}",
+    ]
+    for command, stats in report['commands'].items():
+        lines.append(f"{command:<10} {stats['count']:>7} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота погоды на фейковом OpenWeatherMap')
+    parser.add_argument('--users', type=int, default=100, help='число пользователей')
+    parser.add_argument('--requests', type=int, default=2000, help='число команд')
+    parser.add_argument('--workers', type=int, default=None, help='потоков обработки (по умолчанию BOT_WORKERS)')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='средняя задержка API')
+    parser.add_argument('--jitter-ms', type=float, default=10.0, help='разброс задержки API')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов API с ошибкой 500')
+    parser.add_argument('--skew', type=float, default=1.1, help='параметр Zipf популярности городов')
+    parser.add_argument('--send-latency-ms', type=float, default=0.0, help='задержка send_message')
+    parser.add_argument('--calls-per-minute', type=float, default=6000.0, help='лимит запросов к API в минуту')
+    parser.add_argument('--cache-backend', help='общий кэш, например sqlite:///bench-cache.db; '
+                                                'повторный запуск с тем же файлом имитирует перезапуск бота')
+    parser.add_argument('--cache-ttl', type=float, help='время жизни кэша текущей погоды, секунды '
+                                                     '(по умолчанию WEATHER_CACHE_TTL)')
+    parser.add_argument('--refresh', action='store_true', help='заранее обновлять популярные города в фоне')
+    parser.add_argument('--rate', type=float, help='команд в секунду (по умолчанию - максимально быстро)')
+    parser.add_argument('--profile-share', type=float, default=0.0,
+                        help='доля пользователей с городом по умолчанию, спрашивающих без названия города')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='вывести отчет в JSON')
+    parser.add_argument('--max-p99-ms', type=float, help='завершиться с ошибкой, если p99 выше порога')
+    parser.add_argument('--max-upstream-calls', type=int, help='завершиться с ошибкой, если запросов к API больше')
+    args = parser.parse_args()
+
+    # Ошибки API в обработчиках ожидаемы при --error-rate и не должны засорять отчет
+    logging.basicConfig(level=logging.CRITICAL)
+
+    report = run_benchmark(
+        users=args.users, requests_count=args.requests, workers=args.workers,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        skew=args.skew, send_latency_ms=args.send_latency_ms, calls_per_minute=args.calls_per_minute,
+        seed=args.seed, cache_backend_url=args.cache_backend, cache_ttl=args.cache_ttl, refresh=args.refresh,
+        rate=args.rate, profile_share=args.profile_share,
+    )
+    print(json.dumps(report, ensure_ascii=False, indent=2) if args.json else format_report(report))
+
+    failures = []
+    if args.max_p99_ms is not None and report['latency']['p99_ms'] > args.max_p99_ms:
+        failures.append(f"p99 {report['latency']['p99_ms']} мс превышает {args.max_p99_ms} мс")
+    if args.max_upstream_calls is not None and report['upstream_calls']['total'] > args.max_upstream_calls:
+        failures.append(f"запросов к API {report['upstream_calls']['total']} больше {args.max_upstream_calls}")
+    for failure in failures:
+        print(f'Регрессия: {failure}', file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+import metrics
+from storage import Database
+
+backend_errors_total = metrics.registry.counter(
+    'cache_backend_errors_total', 'Ошибки общего кэша, запрос обслужен без него', ('operation',))
+
+
+class CacheBackendError(Exception):
+    pass
+
+
+def _encode_key(key):
+    return json.dumps(list(key), ensure_ascii=False)
+
+
+def _decode_key(text):
+    return tuple(json.loads(text))
+
+
+class CacheBackend:
+    """Общий кэш ответов OpenWeatherMap второго уровня, переживающий перезапуск
+
+    Ключ - кортеж, первый элемент которого задает вид данных ('weather',
+    'forecast'). Запись актуальна ttl секунд, после чего еще retention секунд
+    хранится как устаревшая: для отдачи при сбое API и для прогрева кэша.
+    Популярность ключа - число обращений к нему через count(), в том числе
+    обслуженных кэшем в памяти; счетчики копятся в процессе и записываются
+    пачкой раз в COUNT_FLUSH_INTERVAL секунд.
+
+    Ошибки хранилища не прерывают обработку команды: они логируются, а
+    операция ведет себя как промах кэша.
+    """
+
+    COUNT_FLUSH_INTERVAL = 5.0
+
+    def __init__(self, max_size=10000, retention=86400):
+        self.max_size = max_size
+        self.retention = retention
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._counts = {}
+        self._counted_at = time.monotonic()
+
+    def get(self, key, stale=False):
+        """(значение, время истечения по time.time()) или None; при stale=True - и устаревшее"""
+        try:
+            entry = self._get(_encode_key(key))
+        except (CacheBackendError, sqlite3.Error, OSError, ValueError) as e:
+            self._error('get', e)
+            return None
+        hit = entry is not None and (stale or entry[1] > time.time())
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry if hit else None
+
+    def set(self, key, value, ttl):
+        try:
+            self._set(_encode_key(key), key[0], value, time.time() + ttl)
+        except (CacheBackendError, sqlite3.Error, OSError, ValueError) as e:
+            self._error('set', e)
+
+    def count(self, key, requests=1):
+        """Учитывает обращение к ключу для top()"""
+        now = time.monotonic()
+        with self._stats_lock:
+            self._counts[key] = self._counts.get(key, 0) + requests
+            if now - self._counted_at < self.COUNT_FLUSH_INTERVAL:
+                return
+            batch, self._counts, self._counted_at = self._counts, {}, now
+        self._write_counts(batch)
+
+    def flush_counts(self):
+        with self._stats_lock:
+            batch, self._counts, self._counted_at = self._counts, {}, time.monotonic()
+        if batch:
+            self._write_counts(batch)
+
+    def _write_counts(self, batch):
+        try:
+            self._add_requests([(_encode_key(key), key[0], requests) for key, requests in batch.items()])
+        except (CacheBackendError, sqlite3.Error, OSError, ValueError) as e:
+            self._error('count', e)
+
+    def top(self, kind, n):
+        """Самые часто запрашиваемые ключи вида kind вместе с последними значениями"""
+        try:
+            return [(_decode_key(key), value) for key, value in self._top(kind, n)]
+        except (CacheBackendError, sqlite3.Error, OSError, ValueError) as e:
+            self._error('top', e)
+            return []
+
+    def stats(self):
+        with self._stats_lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        self.flush_counts()
+
+    @staticmethod
+    def _error(operation, error):
+        logging.warning(f'Ошибка общего кэша ({operation}): {error}')
+        backend_errors_total.inc(operation)
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, kind, value, expires_at):
+        raise NotImplementedError
+
+    def _top(self, kind, n):
+        raise NotImplementedError
+
+    def _add_requests(self, rows):
+        """rows - (закодированный ключ, вид, число обращений)"""
+        raise NotImplementedError
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Кэш в файле SQLite (WAL); файл можно разделять между процессами одной машины"""
+
+    # Лишние записи удаляются раз в TRIM_EVERY записей, а не при каждой
+    TRIM_EVERY = 100
+
+    def __init__(self, path, max_size=10000, retention=86400):
+        super().__init__(max_size, retention)
+        self.database = Database(path)
+        self._writes = 0
+        self._lock = threading.Lock()
+        conn = self.database.connection()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    requests INTEGER NOT NULL DEFAULT 1
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_popular ON cache (kind, requests)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache (expires_at)')
+
+    def close(self):
+        super().close()
+        self.database.close()
+
+    def _get(self, key):
+        with metrics.db_operation('cache_get'):
+            row = self.database.connection().execute(
+                'SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _set(self, key, kind, value, expires_at):
+        conn = self.database.connection()
+        with metrics.db_operation('cache_set'), conn:
+            conn.execute('''
+                INSERT INTO cache (key, kind, value, expires_at, requests) VALUES (?, ?, ?, ?, 0)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            ''', (key, kind, json.dumps(value, ensure_ascii=False), expires_at))
+        with self._lock:
+            self._writes += 1
+            trim = self._writes % self.TRIM_EVERY == 0
+        if trim:
+            self._trim(conn)
+
+    def _top(self, kind, n):
+        with metrics.db_operation('cache_top'):
+            rows = self.database.connection().execute(
+                'SELECT key, value FROM cache WHERE kind = ? ORDER BY requests DESC LIMIT ?', (kind, n)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def _add_requests(self, rows):
+        conn = self.database.connection()
+        with metrics.db_operation('cache_count'), conn:
+            conn.executemany('UPDATE cache SET requests = requests + ? WHERE key = ?',
+                             [(requests, key) for key, _, requests in rows])
+
+    def _trim(self, conn):
+        """Удаляет записи старше retention и самые старые сверх max_size"""
+        with metrics.db_operation('cache_trim'), conn:
+            conn.execute('DELETE FROM cache WHERE expires_at < ?', (time.time() - self.retention,))
+            conn.execute('''
+                DELETE FROM cache WHERE key IN (
+                    SELECT key FROM cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_size,))
+
+
+class RespConnection:
+    """Минимальный клиент протокола Redis (RESP2) поверх сокета"""
+
+    def __init__(self, host, port, db=0, password=None, timeout=1.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+        if password:
+            self.execute('AUTH', password)
+        if db:
+            self.execute('SELECT', db)
+
+    def execute(self, *command):
+        return self.pipeline([command])[0]
+
+    def pipeline(self, commands):
+        """Отправляет команды одним пакетом и читает ответы по порядку"""
+        payload = bytearray()
+        for command in commands:
+            payload += b'*%d\r\n' % len(command)
+            for arg in command:
+                data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+                payload += b'$%d\r\n%s\r\n' % (len(data), data)
+        self.sock.sendall(payload)
+        return [self._read() for _ in commands]
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise CacheBackendError('Соединение с Redis закрыто')
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b'+':
+            return body.decode('utf-8')
+        if prefix == b'-':
+            raise CacheBackendError(body.decode('utf-8'))
+        if prefix == b':':
+            return int(body)
+        if prefix == b'$':
+            size = int(body)
+            if size < 0:
+                return None
+            data = self.reader.read(size + 2)
+            return data[:-2]
+        if prefix == b'*':
+            size = int(body)
+            return None if size < 0 else [self._read() for _ in range(size)]
+        raise CacheBackendError(f'Неизвестный ответ Redis: {line!r}')
+
+
+class RedisCacheBackend(CacheBackend):
+    """Кэш в Redis или совместимом сервере; общий для процессов на разных машинах
+
+    Значение хранится строкой с собственным PX, равным ttl + retention.
+    Популярность ключей ведется в sorted set на каждый вид данных, а
+    sorted set по времени записи ограничивает число ключей max_size.
+    Ключ попадает в набор популярности только при записи значения, и
+    обращения к ключам, которых нет в кэше (опечатки, 404), не учитываются:
+    иначе набор рос бы без ограничений.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6379, db=0, password=None, prefix='owm',
+                 max_size=10000, retention=86400, timeout=1.0):
+        super().__init__(max_size, retention)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def close(self):
+        super().close()
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _call(self, commands):
+        """Выполняет команды на соединении текущего потока; после ошибки соединение пересоздается"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = RespConnection(self.host, self.port, self.db, self.password, self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        try:
+            return conn.pipeline(commands)
+        except (CacheBackendError, OSError):
+            self._local.conn = None
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            conn.close()
+            raise
+
+    def _get(self, key):
+        data = self._call([('GET', f'{self.prefix}:value:{key}')])[0]
+        if data is None:
+            return None
+        entry = json.loads(data)
+        return entry['value'], entry['expires_at']
+
+    def _set(self, key, kind, value, expires_at):
+        now = time.time()
+        ttl_ms = int((expires_at - now + self.retention) * 1000)
+        entry = json.dumps({'value': value, 'expires_at': expires_at}, ensure_ascii=False)
+        keys = f'{self.prefix}:keys'
+        replies = self._call([
+            ('SET', f'{self.prefix}:value:{key}', entry, 'PX', ttl_ms),
+            ('ZADD', keys, now, key),
+            ('ZADD', f'{self.prefix}:popular:{kind}', 'NX', 0, key),
+            ('ZCARD', keys),
+        ])
+        excess = replies[-1] - self.max_size
+        if excess > 0:
+            # Вытесняем самые давно записанные ключи
+            names = [name.decode('utf-8') for name in self._call([('ZPOPMIN', keys, excess)])[0][::2]]
+            commands = [('DEL',) + tuple(f'{self.prefix}:value:{name}' for name in names)]
+            for name in names:
+                commands.append(('ZREM', f'{self.prefix}:popular:{_decode_key(name)[0]}', name))
+            self._call(commands)
+
+    def _add_requests(self, rows):
+        # XX: счетчик увеличивается только у ключей, уже записанных в кэш, как UPDATE в SQLite
+        self._call([('ZADD', f'{self.prefix}:popular:{kind}', 'XX', 'INCR', requests, key)
+                    for key, kind, requests in rows])
+
+    def _top(self, kind, n):
+        members = self._call([('ZREVRANGE', f'{self.prefix}:popular:{kind}', 0, n - 1)])[0]
+        if not members:
+            return []
+        names = [member.decode('utf-8') for member in members]
+        values = self._call([('MGET',) + tuple(f'{self.prefix}:value:{name}' for name in names)])[0]
+        return [(name, json.loads(data)['value']) for name, data in zip(names, values) if data is not None]
+
+
+def open_backend(url, max_size=10000, retention=86400):
+    """Создает общий кэш по адресу sqlite:///path/cache.db или redis://[:password@]host:port/db
+
+    Пустой адрес - общий кэш отключен, возвращается None.
+    """
+    if not url:
+        return None
+    parts = urlsplit(url)
+    if parts.scheme == 'sqlite':
+        return SQLiteCacheBackend(parts.path[1:] if parts.path.startswith('/') else parts.path,
+                                  max_size=max_size, retention=retention)
+    if parts.scheme == 'redis':
+        return RedisCacheBackend(parts.hostname or '127.0.0.1', parts.port or 6379,
+                                 db=int(parts.path.strip('/') or 0), password=parts.password,
+                                 max_size=max_size, retention=retention)
+    raise ValueError(f'Неизвестный тип общего кэша: {url}')
@@ -0,0 +1,388 @@
+import array
+import difflib
+import gzip
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import unicodedata
+from collections import namedtuple
+
+City = namedtuple('City', ['id', 'name', 'country', 'lat', 'lon'])
+
+_MAGIC = b'OWCI'
+_VERSION = 3
+# magic, версия, порядок байт (0 - little, 1 - big), число записей, размеры блоков ключей и имен
+_HEADER = struct.Struct('<4sHHIII')
+
+_TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya', '-': ' ', '.': ' ', "'": '', '’': '',
+}
+_TRANSLIT_TABLE = str.maketrans(_TRANSLIT)
+
+# Названия, транслитерация которых не совпадает с названием в списке OpenWeatherMap:
+# ключ -> (ключ канонического названия, страна). Без них "Москва" ("moskva") находит
+# одноименную область, а не город, и попадает в кэш отдельно от "Moscow".
+ALIASES = {
+    'moskva': ('moscow', 'RU'),
+    'sankt peterburg': ('saint petersburg', 'RU'),
+    'peterburg': ('saint petersburg', 'RU'),
+    'spb': ('saint petersburg', 'RU'),
+    'ekaterinburg': ('yekaterinburg', 'RU'),
+    'rostov na donu': ('rostov on don', 'RU'),
+    'nizhniy novgorod': ('nizhny novgorod', 'RU'),
+    'nizhnii novgorod': ('nizhny novgorod', 'RU'),
+    'naberezhnye chelny': ('naberezhnyye chelny', 'RU'),
+    'erevan': ('yerevan', 'AM'),
+    'kiev': ('kyiv', 'UA'),
+    'kiyev': ('kyiv', 'UA'),
+    'parizh': ('paris', 'FR'),
+    'rim': ('rome', 'IT'),
+    'vena': ('vienna', 'AT'),
+    'praga': ('prague', 'CZ'),
+    'varshava': ('warsaw', 'PL'),
+    'myunkhen': ('munich', 'DE'),
+    'kyoln': ('cologne', 'DE'),
+    'lissabon': ('lisbon', 'PT'),
+    'afiny': ('athens', 'GR'),
+    'stambul': ('istanbul', 'TR'),
+    'pekin': ('beijing', 'CN'),
+    'tokio': ('tokyo', 'JP'),
+    'nyu york': ('new york', 'US'),
+    'vashington': ('washington', 'US'),
+    'kopengagen': ('copenhagen', 'DK'),
+    'bryussel': ('brussels', 'BE'),
+    'zheneva': ('geneva', 'CH'),
+    'tsyurikh': ('zurich', 'CH'),
+    'gaaga': ('the hague', 'NL'),
+}
+
+_ALIAS_TARGETS = set(ALIASES.values())
+
+# Столицы: при одинаковом названии (London GB и London CA, Moscow RU и Moscow US)
+# выбирается столица, затем более населенный город, если население есть в выгрузке
+CAPITALS = {
+    ('moscow', 'RU'), ('london', 'GB'), ('paris', 'FR'), ('berlin', 'DE'), ('madrid', 'ES'),
+    ('rome', 'IT'), ('vienna', 'AT'), ('prague', 'CZ'), ('warsaw', 'PL'), ('budapest', 'HU'),
+    ('athens', 'GR'), ('lisbon', 'PT'), ('dublin', 'IE'), ('amsterdam', 'NL'), ('brussels', 'BE'),
+    ('bern', 'CH'), ('copenhagen', 'DK'), ('oslo', 'NO'), ('stockholm', 'SE'), ('helsinki', 'FI'),
+    ('tallinn', 'EE'), ('riga', 'LV'), ('vilnius', 'LT'), ('minsk', 'BY'), ('kyiv', 'UA'),
+    ('chisinau', 'MD'), ('bucharest', 'RO'), ('sofia', 'BG'), ('belgrade', 'RS'), ('zagreb', 'HR'),
+    ('ljubljana', 'SI'), ('bratislava', 'SK'), ('tbilisi', 'GE'), ('yerevan', 'AM'), ('baku', 'AZ'),
+    ('astana', 'KZ'), ('tashkent', 'UZ'), ('bishkek', 'KG'), ('dushanbe', 'TJ'), ('ashgabat', 'TM'),
+    ('ankara', 'TR'), ('beijing', 'CN'), ('tokyo', 'JP'), ('seoul', 'KR'), ('new delhi', 'IN'),
+    ('washington', 'US'), ('ottawa', 'CA'), ('mexico city', 'MX'), ('canberra', 'AU'),
+    ('cairo', 'EG'), ('buenos aires', 'AR'), ('brasilia', 'BR'), ('ulaanbaatar', 'MN'),
+}
+
+# Нечеткий поиск сравнивает не больше стольких ключей: промах не должен стоить миллисекунды
+FUZZY_MAX_CANDIDATES = 100
+
+# Префикс, которому соответствует больше ключей, слишком неоднозначен: город ищется нечетким поиском
+PREFIX_MAX_CANDIDATES = 500
+
+# Вес записи для выбора среди совпадений по префиксу: псевдоним и столица выше любого населения
+_ALIAS_WEIGHT = 0xFFFFFFFF
+_CAPITAL_WEIGHT = 0xFFFFFFFE
+
+
+def normalize_name(text):
+    """Приводит название к ключу индекса: регистр, пробелы, диакритика, кириллица -> латиница"""
+    text = text.casefold().translate(_TRANSLIT_TABLE)
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.split())
+
+
+def _split_country(text):
+    """Отделяет необязательный код страны: "London, GB" -> ("London", "GB")"""
+    name, sep, country = text.rpartition(',')
+    country = country.strip()
+    if sep and len(country) == 2 and country.isalpha():
+        return name, country.upper()
+    return text, None
+
+
+def _read_city_list(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _rank(city, primary, key, alias):
+    """Порядок одноименных записей: псевдоним, столица, население, основное название, id
+
+    primary - ключ основного названия города.
+    """
+    population = (city.get('stat') or {}).get('population') or 0
+    return (not alias, (primary, city.get('country') or '') not in CAPITALS, -population,
+            key != primary, city['id'])
+
+
+def _weight(rank):
+    """Вес записи по ее рангу _rank: чем больше, тем предпочтительнее совпадение по префиксу"""
+    not_alias, not_capital, population = rank[:3]
+    if not not_alias:
+        return _ALIAS_WEIGHT
+    if not not_capital:
+        return _CAPITAL_WEIGHT
+    return min(-population, _CAPITAL_WEIGHT - 1)
+
+
+def build_index(source_path, index_path):
+    """Собирает компактный индекс из city.list.json(.gz) OpenWeatherMap"""
+    entries = []
+    canonical = {}
+    for city in _read_city_list(source_path):
+        names = {city['name']}
+        # В старых выгрузках есть альтернативные названия на разных языках
+        for alt in city.get('langs', ()):
+            names.update(value for value in alt.values() if isinstance(value, str))
+
+        primary = normalize_name(city['name'])
+        keys = {normalize_name(name) for name in names}
+        for key in keys:
+            if key:
+                entries.append((key.encode('utf-8'), _rank(city, primary, key, False), city))
+
+        target = (primary, city.get('country') or '')
+        if target in _ALIAS_TARGETS:
+            best = canonical.get(target)
+            if best is None or _rank(city, primary, primary, False) < _rank(best, primary, primary, False):
+                canonical[target] = city
+
+    for alias, target in ALIASES.items():
+        city = canonical.get(target)
+        if city is not None:
+            entries.append((alias.encode('utf-8'), _rank(city, target[0], alias, True), city))
+
+    # Сортируем по байтам UTF-8 - так же, как сравниваются ключи при поиске; одноименные - по рангу
+    entries.sort(key=lambda entry: entry[:2])
+
+    keys_blob = bytearray()
+    names_blob = bytearray()
+    key_offsets = array.array('I', [0])
+    name_offsets = array.array('I', [0])
+    ids = array.array('i')
+    lats = array.array('f')
+    lons = array.array('f')
+    weights = array.array('I')
+    countries = bytearray()
+    # Второй порядок записей - по двум первым байтам и длине ключа, для нечеткого поиска
+    by_length = array.array('I', sorted(range(len(entries)),
+                                        key=lambda i: (entries[i][0][:2], len(entries[i][0]), entries[i][0], i)))
+    for key, rank, city in entries:
+        weights.append(_weight(rank))
+        keys_blob += key
+        key_offsets.append(len(keys_blob))
+        names_blob += city['name'].encode('utf-8')
+        name_offsets.append(len(names_blob))
+        ids.append(city['id'])
+        lats.append(city['coord']['lat'])
+        lons.append(city['coord']['lon'])
+        countries += (city.get('country') or '').encode('ascii')[:2].ljust(2)
+
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        byteorder = 0 if sys.byteorder == 'little' else 1
+        f.write(_HEADER.pack(_MAGIC, _VERSION, byteorder, len(entries), len(keys_blob), len(names_blob)))
+        # Числовые массивы идут первыми, чтобы сохранить выравнивание по 4 байта
+        for arr in (key_offsets, name_offsets, ids, lats, lons, by_length, weights):
+            arr.tofile(f)
+        f.write(countries)
+        f.write(keys_blob)
+        f.write(names_blob)
+    os.replace(tmp_path, index_path)
+    return len(entries)
+
+
+def _index_version(path):
+    with open(path, 'rb') as f:
+        header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    magic, version = _HEADER.unpack(header)[:2]
+    return version if magic == _MAGIC else None
+
+
+class CityIndex:
+    """Отображенный в память индекс городов: названия -> id и координаты OpenWeatherMap"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, byteorder, count, keys_size, names_size = _HEADER.unpack_from(self._mm)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f'Файл {path} не является индексом городов')
+        if byteorder != (0 if sys.byteorder == 'little' else 1):
+            raise ValueError(f'Индекс {path} собран на платформе с другим порядком байт')
+
+        view = memoryview(self._mm)
+        offset = _HEADER.size
+
+        def take(size, fmt=None):
+            nonlocal offset
+            chunk = view[offset:offset + size]
+            offset += size
+            return chunk.cast(fmt) if fmt else chunk
+
+        self._count = count
+        self._key_offsets = take(4 * (count + 1), 'I')
+        self._name_offsets = take(4 * (count + 1), 'I')
+        self._ids = take(4 * count, 'i')
+        self._lats = take(4 * count, 'f')
+        self._lons = take(4 * count, 'f')
+        self._by_length = take(4 * count, 'I')
+        self._weights = take(4 * count, 'I')
+        self._countries = take(2 * count)
+        self._keys = take(keys_size)
+        self._names = take(names_size)
+
+    @classmethod
+    def open(cls, path):
+        """Открывает индекс; для city.list.json(.gz) собирает рядом файл .idx при необходимости"""
+        if path.endswith(('.json', '.json.gz')):
+            index_path = path + '.idx'
+            if (not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(path)
+                    or _index_version(index_path) != _VERSION):
+                build_index(path, index_path)
+            path = index_path
+        return cls(path)
+
+    def __len__(self):
+        return self._count
+
+    def resolve(self, text):
+        """Находит город по свободному вводу: точное совпадение, затем префикс, затем нечеткий поиск"""
+        name, country = _split_country(text)
+        key = normalize_name(name).encode('utf-8')
+        if not key:
+            return None
+
+        return (self._exact(key, country)
+                or self._prefix(key, country)
+                or self._fuzzy(key, country))
+
+    def _key(self, i):
+        return self._keys[self._key_offsets[i]:self._key_offsets[i + 1]].tobytes()
+
+    def _country(self, i):
+        return self._countries[2 * i:2 * i + 2].tobytes().decode('ascii').strip()
+
+    def _city(self, i):
+        name = self._names[self._name_offsets[i]:self._name_offsets[i + 1]].tobytes().decode('utf-8')
+        return City(self._ids[i], name, self._country(i), self._lats[i], self._lons[i])
+
+    def _lower_bound(self, key):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _first_matching(self, start, predicate, country):
+        i = start
+        while i < self._count and predicate(self._key(i)):
+            if country is None or self._country(i) == country:
+                return self._city(i)
+            i += 1
+        return None
+
+    def _exact(self, key, country):
+        return self._first_matching(self._lower_bound(key), key.__eq__, country)
+
+    def _prefix(self, key, country):
+        """Лучшее совпадение по префиксу: псевдоним, столица, население, затем самое короткое название
+
+        Первый по алфавиту ключ не годится: "Lond" нашел бы Londa, а не London.
+        """
+        if len(key) < 3:
+            return None
+        best, best_order = None, None
+        start = i = self._lower_bound(key)
+        while i < self._count:
+            current = self._key(i)
+            if not current.startswith(key):
+                break
+            if i - start >= PREFIX_MAX_CANDIDATES:
+                return None
+            if country is None or self._country(i) == country:
+                order = (-self._weights[i], len(current), i)
+                if best_order is None or order < best_order:
+                    best, best_order = i, order
+            i += 1
+        return self._city(best) if best is not None else None
+
+    def _length_bound(self, prefix, length, key=b'', lo=0, hi=None):
+        """Первая позиция в порядке по длине, где (два первых байта, длина, ключ) не меньше заданных"""
+        hi = self._count if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._key(self._by_length[mid])
+            if (current[:2], len(current), current) < (prefix, length, key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _fuzzy(self, key, country, cutoff=0.8):
+        # Кандидаты - ключи с теми же двумя первыми байтами и длиной +-2. В порядке по длине
+        # ключи одной длины идут подряд и по алфавиту: просматриваем их от места, где стоял
+        # бы сам ключ, в обе стороны - соседи с самым длинным общим началом идут первыми.
+        # Всего сравниваем не больше FUZZY_MAX_CANDIDATES ключей, ближайшие длины - раньше
+        prefix = key[:2]
+        matcher = difflib.SequenceMatcher(b=key.decode('utf-8'))
+        best, best_ratio = None, cutoff
+        budget = FUZZY_MAX_CANDIDATES
+        for length in (len(key), len(key) - 1, len(key) + 1, len(key) - 2, len(key) + 2):
+            start = self._length_bound(prefix, length)
+            end = self._length_bound(prefix, length + 1, lo=start)
+            if start == end:
+                continue
+            middle = self._length_bound(prefix, length, key, start, end)
+            below, above = middle - 1, middle
+            while budget > 0 and (below >= start or above < end):
+                if above < end and (below < start or above - middle <= middle - 1 - below):
+                    position, above = above, above + 1
+                else:
+                    position, below = below, below - 1
+                budget -= 1
+                i = self._by_length[position]
+                if country is not None and self._country(i) != country:
+                    continue
+                matcher.set_seq1(self._key(i).decode('utf-8'))
+                if matcher.real_quick_ratio() > best_ratio and matcher.quick_ratio() > best_ratio:
+                    ratio = matcher.ratio()
+                    # При равной похожести побеждает запись с лучшим рангом (меньшим номером)
+                    if ratio > best_ratio or (ratio == best_ratio and best is not None and i < best):
+                        best, best_ratio = i, ratio
+            if budget <= 0:
+                break
+        return self._city(best) if best is not None else None
+
+def load_city_index(path):
+    """Загружает индекс городов или возвращает None, если файл не найден"""
+    if not path or not os.path.exists(path):
+        logging.warning(f'Список городов {path} не найден, города ищутся по названию через API')
+        return None
+    index = CityIndex.open(path)
+    logging.info(f'Загружен индекс городов: {len(index)} записей')
+    return index
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Использование: python city_index.py city.list.json.gz')
+        sys.exit(1)
+    source = sys.argv[1]
+    print(f'Записано {build_index(source, source + ".idx")} записей в {source}.idx')
@@ -13,13 +13,86 @@ class Config:
     # OpenWeatherMap API настройки
     OPENWEATHER_API_KEY = os.getenv('OPENWEATHER_API_KEY')
     OPENWEATHER_BASE_URL = 'http://api.openweathermap.org/data/2.5'
+    OPENWEATHER_TIMEOUT = float(os.getenv('OPENWEATHER_TIMEOUT', '10'))                  # дедлайн запроса, секунды
+    OPENWEATHER_MAX_CONNECTIONS = int(os.getenv('OPENWEATHER_MAX_CONNECTIONS', '20'))    # размер пула keep-alive соединений
+    OPENWEATHER_MAX_CONCURRENCY = int(os.getenv('OPENWEATHER_MAX_CONCURRENCY', '20'))    # одновременных запросов к API
+    OPENWEATHER_BATCH_WORKERS = int(os.getenv('OPENWEATHER_BATCH_WORKERS', '8'))         # параллельных запросов в /compare
+    COMPARE_MAX_CITIES = int(os.getenv('COMPARE_MAX_CITIES', '50'))                      # городов в одной команде /compare
+    
+    # Список городов OpenWeatherMap (http://bulk.openweathermap.org/sample/city.list.json.gz)
+    CITY_LIST_PATH = os.getenv('CITY_LIST_PATH', 'city.list.json.gz')
+    
+    # Защита от перегрузки API
+    OPENWEATHER_CALLS_PER_MINUTE = float(os.getenv('OPENWEATHER_CALLS_PER_MINUTE', '60'))  # лимит тарифа API
+    OPENWEATHER_BURST = int(os.getenv('OPENWEATHER_BURST', '10'))                          # допустимый всплеск запросов
+    OPENWEATHER_RETRIES = int(os.getenv('OPENWEATHER_RETRIES', '2'))                       # повторов при 429, 5xx и таймаутах
+    OPENWEATHER_BACKOFF_BASE = float(os.getenv('OPENWEATHER_BACKOFF_BASE', '0.2'))         # начальная задержка повтора, секунды
+    OPENWEATHER_BACKOFF_MAX = float(os.getenv('OPENWEATHER_BACKOFF_MAX', '2.0'))           # максимальная задержка повтора, секунды
+    OPENWEATHER_RATE_WAIT = float(os.getenv('OPENWEATHER_RATE_WAIT', '0.2'))               # сколько ждать токен лимита, секунды
+    OPENWEATHER_BREAKER_THRESHOLD = int(os.getenv('OPENWEATHER_BREAKER_THRESHOLD', '5'))   # ошибок подряд до размыкания
+    OPENWEATHER_BREAKER_RESET = float(os.getenv('OPENWEATHER_BREAKER_RESET', '30'))        # пауза перед пробным запросом, секунды
+    STALE_FALLBACK = os.getenv('STALE_FALLBACK', '1') == '1'                               # отдавать устаревшие данные при сбое API
+    
+    # Число потоков Dispatcher, обрабатывающих команды
+    BOT_WORKERS = int(os.getenv('BOT_WORKERS', '8'))
+    
+    # Режим получения обновлений: polling - один процесс, webhook - HTTP-сервер и пул процессов
+    BOT_MODE = os.getenv('BOT_MODE', 'polling')
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')                                               # публичный https-адрес webhook
+    WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')                            # адрес локального HTTP-сервера
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')                                         # проверяется в заголовке запроса Telegram
+    WEBHOOK_PROCESSES = int(os.getenv('WEBHOOK_PROCESSES', str(os.cpu_count() or 1)))    # процессов-воркеров
+    WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))                    # обновлений в очереди процесса
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))            # одновременных соединений от Telegram
+    WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30'))              # ожидание обработки при остановке, секунды
     
     # Настройки базы данных
     DATABASE_NAME = os.getenv('DATABASE_NAME', 'users.db')
+    USERS_BATCH_SIZE = int(os.getenv('USERS_BATCH_SIZE', '1'))             # >1 - записывать регистрации пачками
+    USERS_FLUSH_INTERVAL = float(os.getenv('USERS_FLUSH_INTERVAL', '1.0'))  # период записи пачек, секунды
+    PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '200000'))    # настроек пользователей в памяти
+    PROFILE_FLUSH_INTERVAL = float(os.getenv('PROFILE_FLUSH_INTERVAL', '1.0'))  # период записи настроек, секунды
+    PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', '60'))            # перечитывать настройки в режиме webhook, секунды
     
     # Настройки API запросов
-    WEATHER_UNITS = 'metric'  # metric, imperial, kelvin
-    WEATHER_LANG = 'ru'       # язык ответов API
+    WEATHER_UNITS = os.getenv('WEATHER_UNITS', 'metric')  # metric, imperial, standard (Кельвины)
+    WEATHER_LANG = os.getenv('WEATHER_LANG', 'ru')        # язык ответов API и бота (бот переведен на ru и en)
+    
+    # Настройки кэша текущей погоды
+    WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', '600'))     # время жизни записи, секунды
+    WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', '1000'))  # максимальное число городов в кэше
+    
+    # Готовых текстов ответов, переиспользуемых для одинаковых данных
+    RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '4096'))
+    
+    # Общий кэш второго уровня: sqlite:///cache.db или redis://host:6379/0 (пусто - только память процесса)
+    CACHE_BACKEND_URL = os.getenv('CACHE_BACKEND_URL', '')
+    CACHE_BACKEND_SIZE = int(os.getenv('CACHE_BACKEND_SIZE', '10000'))      # максимум записей в общем кэше
+    CACHE_RETENTION = int(os.getenv('CACHE_RETENTION', '86400'))            # хранение устаревших записей, секунды
+    CACHE_WARMUP_SIZE = int(os.getenv('CACHE_WARMUP_SIZE', '20'))           # популярных городов для прогрева при запуске
+    CACHE_WARMUP_CITIES = [city.strip() for city in os.getenv('CACHE_WARMUP_CITIES', '').split(',') if city.strip()]
+    
+    # Фоновое обновление кэша популярных городов незадолго до истечения
+    REFRESH_QUOTA_SHARE = float(os.getenv('REFRESH_QUOTA_SHARE', '0.2'))    # доля лимита API (0 - отключено)
+    REFRESH_TOP_K = int(os.getenv('REFRESH_TOP_K', '50'))                   # сколько самых популярных городов обновлять
+    REFRESH_LEAD = float(os.getenv('REFRESH_LEAD', '30'))                   # за сколько секунд до истечения обновлять
+    REFRESH_INTERVAL = float(os.getenv('REFRESH_INTERVAL', '5'))            # наибольшая пауза между проверками, секунды
+    REFRESH_HALF_LIFE = float(os.getenv('REFRESH_HALF_LIFE', '600'))        # период полураспада счетчиков запросов, секунды
+    REFRESH_MIN_REQUESTS = float(os.getenv('REFRESH_MIN_REQUESTS', '2'))    # минимальный счет города для обновления
+    REFRESH_FORECAST_GAP = float(os.getenv('REFRESH_FORECAST_GAP', '600'))  # не обновлять прогноз чаще, секунды
+    
+    # Настройки рассылки подписок
+    SUBSCRIPTIONS_FETCH_WORKERS = int(os.getenv('SUBSCRIPTIONS_FETCH_WORKERS', '8'))  # параллельных запросов прогноза
+    TELEGRAM_SEND_RATE = float(os.getenv('TELEGRAM_SEND_RATE', '25'))                 # сообщений в секунду (лимит Telegram - 30)
+    SEND_QUEUE_DRAIN_TIMEOUT = float(os.getenv('SEND_QUEUE_DRAIN_TIMEOUT', '10'))     # дослать очередь при остановке, секунды
+    
+    # Число городов, полный прогноз которых хранится в памяти
+    FORECAST_STORE_SIZE = int(os.getenv('FORECAST_STORE_SIZE', '1000'))
+    
+    # Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 - отключены)
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
     
     @classmethod
     def validate_config(cls):
@@ -28,6 +101,8 @@ class Config:
             ('TELEGRAM_BOT_TOKEN', cls.TELEGRAM_BOT_TOKEN),
             ('OPENWEATHER_API_KEY', cls.OPENWEATHER_API_KEY)
         ]
+        if cls.BOT_MODE == 'webhook':
+            required_vars.append(('WEBHOOK_URL', cls.WEBHOOK_URL))
         
         missing_vars = []
         for var_name, var_value in required_vars:
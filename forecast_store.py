@@ -0,0 +1,216 @@
+import array
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+import metrics
+
+ForecastRow = namedtuple('ForecastRow', ['dt', 'temp', 'description'])
+
+# Шаг прогноза OpenWeatherMap /forecast - 3 часа
+STEP_SECONDS = 3 * 3600
+
+# Если к моменту запроса OpenWeatherMap еще не сдвинул ряд, следующая попытка - не раньше чем через столько секунд
+ROLL_RETRY_SECONDS = 600
+
+
+class ForecastSeries:
+    """Прогноз одного города в колоночном виде: время, температура и номер описания"""
+
+    __slots__ = ('city', 'timezone', 'timestamps', 'temps', 'descriptions', 'fetched_at', '_strings')
+
+    def __init__(self, city, tz_offset, timestamps, temps, descriptions, strings, fetched_at):
+        self.city = city
+        self.timezone = tz_offset
+        self.timestamps = timestamps
+        self.temps = temps
+        self.descriptions = descriptions
+        self.fetched_at = fetched_at
+        self._strings = strings
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def is_current(self, now, max_age):
+        """Данные актуальны, пока не наступил первый шаг прогноза и не истек max_age
+
+        Ряд, который уже при получении начинался в прошлом (API не успел его
+        сдвинуть), считается актуальным ROLL_RETRY_SECONDS: иначе каждый
+        запрос прогноза уходил бы в API за тем же рядом.
+        """
+        if not self.timestamps or now - self.fetched_at >= max_age:
+            return False
+        if now < self.timestamps[0]:
+            return True
+        return self.fetched_at >= self.timestamps[0] and now - self.fetched_at < ROLL_RETRY_SECONDS
+
+    def is_stale(self, now=None, max_age=STEP_SECONDS):
+        """Ряд отдан из хранилища, хотя его следовало обновить (API был недоступен)"""
+        return not self.is_current(time.time() if now is None else now, max_age)
+
+    def refresh_at(self, max_age, lead):
+        """Время (time.time()) заблаговременного обновления: за lead до max_age,
+        но не раньше сдвига ряда - до него OpenWeatherMap вернет тот же ряд"""
+        aged = self.fetched_at + max_age - lead
+        if not self.timestamps or aged < self.timestamps[0]:
+            return aged
+        if self.fetched_at >= self.timestamps[0]:
+            # Ряд не был сдвинут при получении: повторяем, когда он перестанет считаться актуальным
+            return min(aged, self.fetched_at + ROLL_RETRY_SECONDS)
+        return self.timestamps[0]
+
+    def rows(self, start=None, end=None):
+        """Строки прогноза с dt в интервале [start, end)"""
+        result = []
+        for i, dt in enumerate(self.timestamps):
+            if start is not None and dt < start:
+                continue
+            if end is not None and dt >= end:
+                break
+            result.append(ForecastRow(dt, self.temps[i], self._strings[self.descriptions[i]]))
+        return result
+
+    def upcoming(self, hours, now=None):
+        """Прогноз на ближайшие hours часов; начинается с текущего трехчасового интервала"""
+        now = time.time() if now is None else now
+        return self.rows(now - STEP_SECONDS, now + hours * 3600)
+
+    def day(self, days_ahead=1, now=None):
+        """Прогноз на календарный день в часовом поясе города (1 - завтра)"""
+        now = time.time() if now is None else now
+        tz = timezone(timedelta(seconds=self.timezone))
+        day_start = datetime.fromtimestamp(now, tz).replace(hour=0, minute=0, second=0, microsecond=0)
+        start = (day_start + timedelta(days=days_ahead)).timestamp()
+        return self.rows(start, start + 24 * 3600)
+
+    @staticmethod
+    def summary(rows):
+        """Минимальная, максимальная и средняя температура по строкам прогноза"""
+        if not rows:
+            return None
+        temps = [row.temp for row in rows]
+        return min(temps), max(temps), sum(temps) / len(temps)
+
+
+class ForecastStore:
+    """Хранит полный пятидневный прогноз по городам и отвечает на запросы без обращения к API
+
+    Прогноз запрашивается заново, только когда первый трехчасовой шаг ушел
+    в прошлое (OpenWeatherMap сдвинул ряд) или запись старше max_age.
+    При stale_fallback и недоступности API отдается последний сохраненный ряд.
+    С backend исходные ответы /forecast сохраняются и в общем кэше, поэтому
+    после перезапуска или в другом процессе ряд собирается без запроса к API.
+    """
+
+    def __init__(self, client, max_size=1000, max_age=STEP_SECONDS, stale_fallback=False, backend=None):
+        self.client = client
+        self.max_size = max_size
+        self.max_age = max_age
+        self.stale_fallback = stale_fallback
+        self.backend = backend
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        # Описания погоды повторяются, поэтому храним каждое один раз на все города
+        self._strings = []
+        self._string_ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, city, force=False, units=None, lang=None):
+        """Прогноз города; None, если OpenWeatherMap не нашел город
+
+        force=True - запросить API, даже если сохраненный ряд актуален (фоновое обновление).
+        units и lang заменяют единицы и язык клиента.
+        """
+        key = self.client.location_key(city, units, lang)
+        now = time.time()
+        if self.backend is not None and not force:
+            self.backend.count(('forecast',) + key)
+        with self._lock:
+            series = self._series.get(key)
+            if series is not None and series.is_current(now, self.max_age) and not force:
+                self._series.move_to_end(key)
+                self.hits += 1
+                return series
+            if not force:
+                self.misses += 1
+
+        shared = self._from_backend(key)
+        if shared is not None and shared.is_current(now, self.max_age) and not force:
+            self._remember(key, shared)
+            return shared
+
+        try:
+            data = self.client.forecast(city, units=units, lang=lang)
+        except requests.exceptions.RequestException as e:
+            if series is None:
+                series = shared
+            if series is None or not self.stale_fallback or force:
+                raise
+            logging.warning(f'Прогноз отдан из устаревших данных: {e}')
+            metrics.stale_responses_total.inc('forecast')
+            return series
+        if data.get('cod') != '200':
+            return None
+
+        if self.backend is not None:
+            self.backend.set(('forecast',) + key, dict(data, fetched_at=now), self.max_age)
+        series = self._build(data, now)
+        self._remember(key, series)
+        return series
+
+    def refresh_at(self, city, lead, units=None, lang=None, min_gap=0.0):
+        """Когда заранее обновить ряд города (time.time()), но не раньше min_gap
+        секунд после его получения; None, если ряда в памяти нет"""
+        key = self.client.location_key(city, units, lang)
+        with self._lock:
+            series = self._series.get(key)
+        if series is None:
+            return None
+        return max(series.refresh_at(self.max_age, lead), series.fetched_at + min_gap)
+
+    def _from_backend(self, key):
+        """Ряд из общего кэша, в том числе устаревший; None, если его там нет"""
+        if self.backend is None:
+            return None
+        shared = self.backend.get(('forecast',) + key, stale=True)
+        if shared is None:
+            return None
+        data = shared[0]
+        return self._build(data, data['fetched_at'])
+
+    def _remember(self, key, series):
+        with self._lock:
+            self._series[key] = series
+            self._series.move_to_end(key)
+            while len(self._series) > self.max_size:
+                self._series.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._series), 'hits': self.hits, 'misses': self.misses,
+                    'descriptions': len(self._strings)}
+
+    def _intern(self, text):
+        with self._lock:
+            index = self._string_ids.get(text)
+            if index is None:
+                index = self._string_ids[text] = len(self._strings)
+                self._strings.append(text)
+            return index
+
+    def _build(self, data, now):
+        timestamps = array.array('q')
+        temps = array.array('f')
+        descriptions = array.array('H')
+        for item in data['list']:
+            timestamps.append(item['dt'])
+            temps.append(item['main']['temp'])
+            descriptions.append(self._intern(item['weather'][0]['description']))
+        city = data.get('city', {})
+        return ForecastSeries(city.get('name'), city.get('timezone', 0), timestamps, temps,
+                              descriptions, self._strings, now)
@@ -0,0 +1,267 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telegram
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        suffix = '_total' if not self.name.endswith('_total') else ''
+        for labels, value in values:
+            yield f'{self.name}{suffix}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+
+
+class Gauge:
+    """Значение, которое считывается функцией в момент экспорта"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def samples(self):
+        yield f'{self.name} {_format_value(self.callback())}'
+
+
+class CallbackCounter(Gauge):
+    """Счетчик, который ведет другой объект (кэш, клиент API); значение считывается в момент экспорта
+
+    В отличие от Gauge экспортируется с типом counter, чтобы rate() учитывал сброс при перезапуске.
+    """
+    type = 'counter'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            snapshot = sorted((labels, list(s[0]), s[1], s[2]) for labels, s in self._series.items())
+        for labels, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = ('le', _format_value(bound))
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}'
+
+
+class Registry:
+    """Набор метрик с выводом в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback):
+        return self.register(Gauge(name, documentation, callback))
+
+    def callback_counter(self, name, documentation, callback):
+        return self.register(CallbackCounter(name, documentation, callback))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                logging.error(f'Ошибка при сборе метрики {metric.name}: {e}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+commands_total = registry.counter(
+    'bot_commands_total', 'Обработанные команды бота', ('command', 'status'))
+command_seconds = registry.histogram(
+    'bot_command_duration_seconds', 'Полное время обработки команды', ('command',))
+stage_seconds = registry.histogram(
+    'bot_command_stage_seconds', 'Время этапов обработки команды', ('command', 'stage'))
+upstream_responses_total = registry.counter(
+    'owm_upstream_responses_total', 'Ответы OpenWeatherMap по кодам статуса', ('endpoint', 'status'))
+upstream_timeouts_total = registry.counter(
+    'owm_upstream_timeouts_total', 'Таймауты запросов к OpenWeatherMap', ('endpoint',))
+upstream_errors_total = registry.counter(
+    'owm_upstream_errors_total', 'Сетевые ошибки запросов к OpenWeatherMap', ('endpoint',))
+upstream_retries_total = registry.counter(
+    'owm_upstream_retries_total', 'Повторные запросы к OpenWeatherMap', ('endpoint',))
+upstream_rejected_total = registry.counter(
+    'owm_upstream_rejected_total', 'Запросы, отклоненные без обращения к OpenWeatherMap', ('endpoint', 'reason'))
+stale_responses_total = registry.counter(
+    'owm_stale_responses_total', 'Ответы из устаревших данных при недоступности OpenWeatherMap', ('endpoint',))
+db_seconds = registry.histogram(
+    'db_operation_duration_seconds', 'Время операций с базой данных', ('operation',))
+
+# Этапы, время которых измеряется явно; остаток времени команды считается форматированием
+_MEASURED_STAGES = ('fetch', 'parse', 'send', 'db')
+_current = threading.local()
+
+
+@contextmanager
+def stage(name):
+    """Засекает этап обработки текущей команды (fetch, parse, send, db)
+
+    Время вложенных этапов вычитается из внешнего, чтобы этапы не пересекались.
+    """
+    stages = getattr(_current, 'stages', None)
+    if stages is None:
+        yield
+        return
+
+    _current.nested.append(0.0)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        nested = _current.nested.pop()
+        stages[name] = stages.get(name, 0.0) + elapsed - nested
+        if _current.nested:
+            _current.nested[-1] += elapsed
+
+
+@contextmanager
+def db_operation(operation):
+    started = time.perf_counter()
+    with stage('db'):
+        try:
+            yield
+        finally:
+            db_seconds.observe(time.perf_counter() - started, operation)
+
+
+def instrument(command, callback):
+    """Оборачивает обработчик команды сбором счетчиков и времени этапов"""
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        _current.stages = stages = {}
+        _current.nested = []
+        status = 'ok'
+        started = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.stages = None
+            commands_total.inc(command, status)
+            command_seconds.observe(elapsed, command)
+            for name in _MEASURED_STAGES:
+                if name in stages:
+                    stage_seconds.observe(stages[name], command, name)
+            stage_seconds.observe(max(elapsed - sum(stages.values()), 0.0), command, 'format')
+
+    return wrapper
+
+
+class InstrumentedBot(telegram.Bot):
+    """Bot, засекающий время send_message как этап send"""
+
+    def send_message(self, *args, **kwargs):
+        with stage('send'):
+            return super().send_message(*args, **kwargs)
+
+
+def start_http_server(port, host='127.0.0.1'):
+    """Запускает в фоновом потоке HTTP-сервер с метриками по адресу /metrics"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logging.info(f'Метрики доступны на http://{host}:{server.server_port}/metrics')
+    return server
@@ -0,0 +1,209 @@
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import metrics
+from city_index import City
+
+refreshes_total = metrics.registry.counter(
+    'owm_refreshes_total', 'Фоновые обновления кэша популярных городов', ('endpoint', 'result'))
+
+
+class DecayingCounter:
+    """Счетчики запросов по ключам, затухающие экспоненциально с периодом полураспада half_life
+
+    Вместо умножения всех счетчиков на каждом шаге вес новых событий растет
+    со временем; при переполнении шкалы веса счетчики нормируются.
+    """
+
+    def __init__(self, half_life=600.0, max_size=10000):
+        self.half_life = half_life
+        self.max_size = max_size
+        self._scores = {}
+        self._values = {}
+        self._origin = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, key, value=None, amount=1.0):
+        """Учитывает событие по ключу; value - связанный с ключом объект (город)"""
+        with self._lock:
+            weight = self._weight(time.monotonic())
+            self._scores[key] = self._scores.get(key, 0.0) + amount * weight
+            self._values[key] = value
+            if weight > 1e12:
+                self._rescale(weight)
+            if len(self._scores) > self.max_size:
+                self._prune()
+
+    def discard(self, key):
+        with self._lock:
+            self._scores.pop(key, None)
+            self._values.pop(key, None)
+
+    def top(self, k, min_score=0.0):
+        """k самых популярных ключей: список (ключ, значение, текущий счет) по убыванию счета"""
+        with self._lock:
+            weight = self._weight(time.monotonic())
+            ranked = sorted(self._scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(key, self._values[key], score / weight) for key, score in ranked
+                    if score / weight >= min_score]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._scores)
+
+    def _weight(self, now):
+        return math.pow(2.0, (now - self._origin) / self.half_life)
+
+    def _rescale(self, weight):
+        for key in self._scores:
+            self._scores[key] /= weight
+        self._origin = time.monotonic()
+
+    def _prune(self):
+        # Отбрасываем менее популярную половину
+        ranked = sorted(self._scores, key=self._scores.get)
+        for key in ranked[:len(ranked) // 2]:
+            del self._scores[key]
+            del self._values[key]
+
+
+class Refresher:
+    """Заранее обновляет кэш текущей погоды и прогноза для самых популярных городов
+
+    Работает в собственном потоке и не занимает потоки обработки команд.
+    Текущая погода обновляется за lead секунд до истечения записи в кэше,
+    прогноз - за lead секунд до max_age или в момент сдвига ряда
+    OpenWeatherMap. Запросы ограничены своим token bucket'ом - долей от
+    лимита API, самые популярные города обновляются первыми. Прогноз одного
+    города обновляется не чаще раза в forecast_gap секунд, чтобы ряд, который
+    OpenWeatherMap не сдвигает, не занял всю долю лимита. Город с разными
+    единицами или языком ответа - это разные записи кэша, и они учитываются
+    раздельно.
+    """
+
+    def __init__(self, client, forecast_store, bucket, top_k=50, lead=30.0, interval=5.0,
+                 half_life=600.0, min_score=2.0, forecast_gap=600.0):
+        self.client = client
+        self.forecast_store = forecast_store
+        self.bucket = bucket
+        self.top_k = top_k
+        self.lead = lead
+        self.interval = interval
+        self.min_score = min_score
+        self.forecast_gap = forecast_gap
+        self.counter = DecayingCounter(half_life)
+        self._stop = threading.Event()
+        self._thread = None
+        self._pool = ThreadPoolExecutor(max_workers=client.batch_workers, thread_name_prefix='cache-refresher')
+
+    def record(self, city, units=None, lang=None):
+        """Учитывает запрос города (City из индекса или название) с единицами и языком ответа"""
+        key = self.client.location_key(city, units, lang)
+        self.counter.add(key, (city,) + key[-2:])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='cache-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._pool.shutdown()
+
+    def refresh_due(self, now=None):
+        """Обновляет то, что пора обновить; возвращает время (time.time()) следующей проверки"""
+        now = time.time() if now is None else now
+        next_check = now + self.interval
+        weather = []
+        forecasts = []
+        # Обновляется только то, что уже есть в кэше: город, о котором спрашивают
+        # только текущую погоду, не расходует лимит на прогноз
+        for key, request, _ in self.counter.top(self.top_k, self.min_score):
+            expires_in = self.client.cache.expires_in(key) if self.client.cache is not None else None
+            if expires_in is not None:
+                due = now + expires_in - self.lead
+                if due <= now:
+                    weather.append((key, request))
+                else:
+                    next_check = min(next_check, due)
+
+            due = self.forecast_store.refresh_at(request[0], self.lead, *request[1:], min_gap=self.forecast_gap)
+            if due is not None:
+                if due <= now:
+                    forecasts.append((key, request))
+                else:
+                    next_check = min(next_check, due)
+
+        self._refresh_weather(weather)
+        self._refresh_forecasts(forecasts)
+        return next_check
+
+    def _refresh_weather(self, due):
+        """Обновляет текущую погоду одним вызовом current_many: пачки /group и параллельные запросы"""
+        group_size = self.client.GROUP_SIZE
+        selected = {}
+        grouped = {}
+        for key, (city, units, lang) in due:
+            # Пачка /group из group_size городов с одними единицами и языком стоит
+            # одного запроса к API, как и одиночный запрос
+            if isinstance(city, City):
+                needs_token = grouped.get((units, lang), 0) % group_size == 0
+                grouped[units, lang] = grouped.get((units, lang), 0) + 1
+            else:
+                needs_token = True
+            if needs_token and not self.bucket.try_acquire():
+                refreshes_total.inc('weather', 'skipped')
+                break
+            selected.setdefault((units, lang), []).append((key, city))
+
+        for (units, lang), batch in selected.items():
+            results = self.client.current_many([city for _, city in batch], force=True, units=units, lang=lang)
+            for (key, _), data in zip(batch, results):
+                self._account('weather', key, data)
+
+    def _refresh_forecasts(self, due):
+        selected = []
+        for key, city in due:
+            if not self.bucket.try_acquire():
+                refreshes_total.inc('forecast', 'skipped')
+                break
+            selected.append((key, city))
+        if not selected:
+            return
+
+        def refresh(item):
+            key, (city, units, lang) = item
+            try:
+                data = self.forecast_store.get(city, force=True, units=units, lang=lang)
+            except requests.exceptions.RequestException as e:
+                data = e
+            self._account('forecast', key, data)
+
+        list(self._pool.map(refresh, selected))
+
+    def _account(self, endpoint, key, data):
+        if isinstance(data, Exception) or (isinstance(data, dict) and data.get('stale')):
+            logging.debug(f'Не удалось заранее обновить {endpoint} {key}: {data}')
+            refreshes_total.inc(endpoint, 'error')
+        elif data is None or (isinstance(data, dict) and data.get('cod') not in (200, '200')):
+            # Город не нашелся в API: обновлять его бессмысленно
+            self.counter.discard(key)
+            refreshes_total.inc(endpoint, 'not_found')
+        else:
+            refreshes_total.inc(endpoint, 'ok')
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                next_check = self.refresh_due()
+            except Exception as e:
+                logging.error(f'Ошибка фонового обновления кэша: {e}')
+                next_check = time.time() + self.interval
+            self._stop.wait(max(next_check - time.time(), 0.05))
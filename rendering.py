@@ -0,0 +1,279 @@
+import html
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from weather_cache import WeatherCache
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Обозначения единиц OpenWeatherMap: standard (и устаревшее kelvin), metric, imperial
+UNIT_SYMBOLS = {
+    'ru': {
+        'standard': {'temp': 'K', 'speed': 'м/с'},
+        'metric': {'temp': '°C', 'speed': 'м/с'},
+        'imperial': {'temp': '°F', 'speed': 'миль/ч'},
+        'pressure': 'гПа',
+    },
+    'en': {
+        'standard': {'temp': 'K', 'speed': 'm/s'},
+        'metric': {'temp': '°C', 'speed': 'm/s'},
+        'imperial': {'temp': '°F', 'speed': 'mph'},
+        'pressure': 'hPa',
+    },
+}
+
+MESSAGES = {
+    'ru': {
+        'weather': 'Текущая погода в городе {city}:\n{time}: {temp}{temp_unit}, {description}',
+        'sunrise': 'Время восхода солнца в городе {city}:\n{time}',
+        'sunset': 'Время захода солнца в городе {city}:\n{time}',
+        'humidity': 'Уровень влажности в городе {city}:\n{humidity}%',
+        'wind': 'Скорость ветра в городе {city}:\n{speed} {speed_unit}, направление: {direction}',
+        'pressure': 'Атмосферное давление в городе {city}:\n{pressure} {pressure_unit}',
+        'direction': '{deg}°',
+        'direction_unknown': 'неизвестно',
+        'forecast_hours': 'Прогноз погоды в городе {city} на {hours} ч',
+        'forecast_tomorrow': 'Прогноз погоды на завтра в городе {city}',
+        'forecast_daily': 'Прогноз погоды в городе {city}',
+        'forecast_row': '{time}: {temp}{temp_unit}, {description}',
+        'forecast_summary': 'Минимум: {low}{temp_unit}, максимум: {high}{temp_unit}, в среднем: {average}{temp_unit}',
+        'compare': 'Сравнение погоды:',
+        'compare_temp': '{temp}{temp_unit}',
+        'compare_no_data': 'нет данных',
+        'compare_not_found': 'город не найден',
+        'not_found': 'Город "{city}" не найден. Проверьте правильность написания.',
+        'stale': '\n(Сервис погоды временно недоступен, показаны последние сохраненные данные.)',
+        'settings_city': 'Город по умолчанию: {city}. Команды без названия города покажут погоду в нем.',
+        'settings_no_city': 'Город по умолчанию не задан. Пример: /setcity Москва',
+        'settings_units': 'Единицы измерения: {name} ({temp_unit}). Доступны: {choices}.',
+        'settings_lang': 'Язык ответов: {name}. Доступны: {choices}.',
+        'settings_invalid': 'Неизвестное значение "{value}". Доступны: {choices}.',
+        'welcome': 'Привет, {username}! Вы успешно зарегистрированы. Введите команду /help, чтобы получить список доступных команд.',
+        'welcome_back': 'С возвращением, {username}! Введите команду /help, чтобы получить список доступных команд.',
+        'usage_city': 'Пожалуйста, укажите название города или задайте город по умолчанию командой /setcity. Пример: /{command} Москва',
+        'usage_compare': 'Пожалуйста, укажите несколько городов через запятую. Пример: /compare Москва, Казань, Сочи',
+        'usage_subscribe': 'Пожалуйста, укажите город и время рассылки. Пример: /subscribe Москва 07:30',
+        'compare_too_many': 'Можно сравнить не больше {limit} городов за раз.',
+        'compare_missing': 'Города не найдены: {cities}. Проверьте правильность написания.',
+        'subscribed': 'Вы подписаны на ежедневный прогноз погоды в городе {city} в {time} по местному времени ({tz}).',
+        'unsubscribed': 'Подписка отменена.',
+        'no_subscription': 'У вас нет такой подписки.',
+        'error_weather': 'Произошла ошибка при получении данных о погоде. Попробуйте позже.',
+        'error_forecast': 'Произошла ошибка при получении прогноза погоды. Попробуйте позже.',
+        'error_data': 'Произошла ошибка при получении данных. Попробуйте позже.',
+        'error_city_check': 'Произошла ошибка при проверке города. Попробуйте позже.',
+        'error_timezone': 'Не удалось определить часовой пояс города. Попробуйте позже.',
+        'error_subscribe': 'Не удалось сохранить подписку. Попробуйте позже.',
+        'error_unsubscribe': 'Не удалось отменить подписку. Попробуйте позже.',
+        'error_bad_data': 'Получены некорректные данные от сервиса погоды.',
+        'error_unexpected': 'Произошла неожиданная ошибка.',
+        'error_command': 'Неправильный формат команды. Введите /help, чтобы получить список доступных команд.',
+        'help': '''Доступные команды:
+/weather [город] - получить текущую погоду в заданном городе.
+/forecast [город] [часы|завтра] - получить прогноз погоды в заданном городе на сутки, заданное число часов или на завтра.
+/sunrise [город] - получить время восхода солнца в заданном городе.
+/sunset [город] - получить время захода солнца в заданном городе.
+/humidity [город] - получить уровень влажности в заданном городе.
+/wind [город] - получить текущую скорость ветра в заданном городе.
+/pressure [город] - получить текущее атмосферное давление в заданном городе.
+/compare <город1>, <город2>, ... - сравнить текущую погоду в нескольких городах.
+/subscribe <город> <ЧЧ:ММ> - получать прогноз погоды в заданном городе каждый день в указанное время (по местному времени города).
+/unsubscribe [город] - отменить подписку на город или все подписки.
+/setcity [город] - задать город по умолчанию: без названия города команды выше показывают погоду в нем.
+/units [metric|imperial|standard] - выбрать единицы измерения.
+/lang [ru|en] - выбрать язык ответов.
+/help - получить справку и список доступных команд.''',
+    },
+    'en': {
+        'weather': 'Current weather in {city}:\n{time}: {temp}{temp_unit}, {description}',
+        'sunrise': 'Sunrise in {city}:\n{time}',
+        'sunset': 'Sunset in {city}:\n{time}',
+        'humidity': 'Humidity in {city}:\n{humidity}%',
+        'wind': 'Wind in {city}:\n{speed} {speed_unit}, direction: {direction}',
+        'pressure': 'Atmospheric pressure in {city}:\n{pressure} {pressure_unit}',
+        'direction': '{deg}°',
+        'direction_unknown': 'unknown',
+        'forecast_hours': 'Weather forecast for {city}, next {hours} h',
+        'forecast_tomorrow': 'Weather forecast for tomorrow in {city}',
+        'forecast_daily': 'Weather forecast for {city}',
+        'forecast_row': '{time}: {temp}{temp_unit}, {description}',
+        'forecast_summary': 'Min: {low}{temp_unit}, max: {high}{temp_unit}, average: {average}{temp_unit}',
+        'compare': 'Weather comparison:',
+        'compare_temp': '{temp}{temp_unit}',
+        'compare_no_data': 'no data',
+        'compare_not_found': 'city not found',
+        'not_found': 'City "{city}" not found. Please check the spelling.',
+        'stale': '\n(The weather service is temporarily unavailable, showing the last saved data.)',
+        'settings_city': 'Default city: {city}. Commands without a city name will show the weather there.',
+        'settings_no_city': 'No default city is set. Example: /setcity London',
+        'settings_units': 'Units: {name} ({temp_unit}). Available: {choices}.',
+        'settings_lang': 'Reply language: {name}. Available: {choices}.',
+        'settings_invalid': 'Unknown value "{value}". Available: {choices}.',
+        'welcome': 'Hi, {username}! You are registered. Send /help to see the available commands.',
+        'welcome_back': 'Welcome back, {username}! Send /help to see the available commands.',
+        'usage_city': 'Please specify a city or set a default one with /setcity. Example: /{command} London',
+        'usage_compare': 'Please list several cities separated by commas. Example: /compare London, Paris, Berlin',
+        'usage_subscribe': 'Please specify a city and a delivery time. Example: /subscribe London 07:30',
+        'compare_too_many': 'You can compare at most {limit} cities at a time.',
+        'compare_missing': 'Cities not found: {cities}. Please check the spelling.',
+        'subscribed': 'You are subscribed to the daily weather forecast for {city} at {time} local time ({tz}).',
+        'unsubscribed': 'Subscription cancelled.',
+        'no_subscription': 'You have no such subscription.',
+        'error_weather': 'Failed to get the weather. Please try again later.',
+        'error_forecast': 'Failed to get the weather forecast. Please try again later.',
+        'error_data': 'Failed to get the data. Please try again later.',
+        'error_city_check': 'Failed to check the city. Please try again later.',
+        'error_timezone': 'Failed to determine the city timezone. Please try again later.',
+        'error_subscribe': 'Failed to save the subscription. Please try again later.',
+        'error_unsubscribe': 'Failed to cancel the subscription. Please try again later.',
+        'error_bad_data': 'The weather service returned invalid data.',
+        'error_unexpected': 'An unexpected error occurred.',
+        'error_command': 'Invalid command format. Send /help to see the available commands.',
+        'help': '''Available commands:
+/weather [city] - current weather in the city.
+/forecast [city] [hours|tomorrow] - weather forecast for the city for a day, the given number of hours or tomorrow.
+/sunrise [city] - sunrise time in the city.
+/sunset [city] - sunset time in the city.
+/humidity [city] - humidity in the city.
+/wind [city] - current wind speed in the city.
+/pressure [city] - current atmospheric pressure in the city.
+/compare <city1>, <city2>, ... - compare the current weather in several cities.
+/subscribe <city> <HH:MM> - get the weather forecast for the city every day at the given time (city local time).
+/unsubscribe [city] - cancel the subscription to the city or all subscriptions.
+/setcity [city] - set the default city: the commands above show its weather when no city is given.
+/units [metric|imperial|standard] - choose the units.
+/lang [ru|en] - choose the reply language.
+/help - show this help and the list of commands.''',
+    },
+}
+
+# Язык интерфейса для языков API, на которые бот не переведен
+FALLBACK_LANG = 'en'
+
+# Языки, на которые переведены ответы бота; из них пользователь выбирает командой /lang
+LANGUAGES = tuple(MESSAGES)
+
+
+@lru_cache(maxsize=None)
+def templates(lang, units):
+    """Шаблоны сообщений для пары (язык, единицы) с уже подставленными обозначениями единиц"""
+    lang = lang if lang in MESSAGES else FALLBACK_LANG
+    symbols = UNIT_SYMBOLS[lang]
+    unit = symbols.get(units, symbols['standard'])
+    compiled = {}
+    for kind, template in MESSAGES[lang].items():
+        compiled[kind] = (template.replace('{temp_unit}', unit['temp'])
+                                  .replace('{speed_unit}', unit['speed'])
+                                  .replace('{pressure_unit}', symbols['pressure']))
+    return compiled
+
+
+@lru_cache(maxsize=None)
+def city_timezone(offset):
+    """Часовой пояс по смещению от UTC в секундах (поле timezone OpenWeatherMap)"""
+    return timezone(timedelta(seconds=offset))
+
+
+def format_time(timestamp, offset):
+    """Время события в часовом поясе города"""
+    return datetime.fromtimestamp(timestamp, city_timezone(offset)).strftime(TIME_FORMAT)
+
+
+class Renderer:
+    """Собирает тексты ответов по шаблонам и запоминает готовые
+
+    Ответ по одним и тем же данным (вид ответа, город, язык, единицы и время
+    наблюдения) форматируется один раз, поэтому популярные города не
+    требуют работы по форматированию.
+    """
+
+    def __init__(self, ttl=600, max_size=4096):
+        self._memo = WeatherCache(ttl=ttl, max_size=max_size)
+
+    def text(self, kind, lang, units, **values):
+        return templates(lang, units)[kind].format(**values)
+
+    def current(self, kind, city, data, lang, units):
+        """Ответ по текущей погоде: weather, sunrise, sunset, humidity, wind или pressure"""
+        if data.get('dt') is None:
+            return self._current(kind, city, data, templates(lang, units))
+        key = (kind, city, lang, units, data.get('id'), data['dt'], bool(data.get('stale')))
+        message = self._memo.get(key)
+        if message is None:
+            message = self._current(kind, city, data, templates(lang, units))
+            self._memo.set(key, message)
+        return message
+
+    def forecast(self, kind, city, series, rows, lang, units, hours=None, stale=False):
+        """Прогноз по строкам series: kind - forecast_hours, forecast_tomorrow или forecast_daily"""
+        if not rows:
+            return self._forecast(kind, city, series, rows, templates(lang, units), hours, stale)
+        key = (kind, city, lang, units, hours, series.fetched_at, rows[0].dt, rows[-1].dt, stale)
+        message = self._memo.get(key)
+        if message is None:
+            message = self._forecast(kind, city, series, rows, templates(lang, units), hours, stale)
+            self._memo.set(key, message)
+        return message
+
+    def comparison(self, rows, lang, units, stale=False):
+        """Таблица сравнения в HTML: rows - (город, данные /weather или None, если их нет)"""
+        compiled = templates(lang, units)
+        cells = []
+        for city, data in rows:
+            if data is None:
+                cells.append((city, '—', compiled['compare_no_data']))
+            elif data.get('cod') != 200:
+                cells.append((city, '—', compiled['compare_not_found']))
+            else:
+                cells.append((city, compiled['compare_temp'].format(temp=int(data['main']['temp'])),
+                              data['weather'][0]['description']))
+        width = max(len(city) for city, _, _ in cells)
+        lines = [f'{html.escape(city.ljust(width))} {temperature:>6} {html.escape(description)}'
+                 for city, temperature, description in cells]
+        message = compiled['compare'] + '\n<pre>' + '\n'.join(lines) + '</pre>'
+        if stale:
+            message += html.escape(compiled['stale'])
+        return message
+
+    def stats(self):
+        return self._memo.stats()
+
+    @staticmethod
+    def _current(kind, city, data, compiled):
+        offset = data.get('timezone', 0)
+        if kind == 'weather':
+            message = compiled['weather'].format(
+                city=city, time=format_time(data.get('dt') or time.time(), offset),
+                temp=int(data['main']['temp']), description=data['weather'][0]['description'])
+        elif kind in ('sunrise', 'sunset'):
+            message = compiled[kind].format(city=city, time=format_time(data['sys'][kind], offset))
+        elif kind == 'humidity':
+            message = compiled['humidity'].format(city=city, humidity=data['main']['humidity'])
+        elif kind == 'wind':
+            deg = data['wind'].get('deg')
+            direction = compiled['direction_unknown'] if deg is None else compiled['direction'].format(deg=deg)
+            message = compiled['wind'].format(city=city, speed=data['wind']['speed'], direction=direction)
+        elif kind == 'pressure':
+            message = compiled['pressure'].format(city=city, pressure=data['main']['pressure'])
+        else:
+            raise ValueError(f'Неизвестный вид ответа: {kind}')
+        if data.get('stale'):
+            message += compiled['stale']
+        return message
+
+    @staticmethod
+    def _forecast(kind, city, series, rows, compiled, hours, stale):
+        lines = [compiled[kind].format(city=city, hours=hours) + ':']
+        row_template = compiled['forecast_row']
+        for row in rows:
+            lines.append(row_template.format(time=format_time(row.dt, series.timezone),
+                                             temp=int(row.temp), description=row.description))
+        summary = series.summary(rows)
+        if summary is not None:
+            low, high, average = summary
+            lines.append(compiled['forecast_summary'].format(low=int(low), high=int(high), average=int(average)))
+        message = '\n'.join(lines) + '\n'
+        if stale:
+            message += compiled['stale']
+        return message
@@ -0,0 +1,161 @@
+import logging
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import telegram
+
+from rate_limit import TokenBucket
+
+
+class SendQueue:
+    """Очередь исходящих сообщений с ограничением скорости отправки в Telegram"""
+
+    def __init__(self, bot, rate, capacity=None):
+        self.bot = bot
+        self.bucket = TokenBucket(rate, capacity)
+        self._queue = queue.Queue()
+        self._abort = threading.Event()
+        self._thread = None
+        self.sent = 0
+        self.failed = 0
+
+    def put(self, chat_id, text):
+        self._queue.put((chat_id, text))
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='send-queue', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Отправляет оставшиеся сообщения не дольше timeout секунд и останавливает поток
+
+        Сообщения, не отправленные за timeout, отбрасываются: при скорости
+        TELEGRAM_SEND_RATE большая очередь задержала бы остановку на минуты.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self._abort.set()
+            dropped = 0
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                dropped += item is not None
+            self._queue.put(None)
+            logging.warning(f'Остановка очереди отправки: не отправлено {dropped} сообщений подписок')
+        self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None or self._abort.is_set():
+                return
+            chat_id, text = item
+            self.bucket.acquire()
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text)
+                self.sent += 1
+            except telegram.error.RetryAfter as e:
+                # Telegram сам сообщает, сколько ждать; сообщение отправится повторно
+                logging.warning(f'Превышен лимит Telegram, пауза {e.retry_after} с')
+                if self._abort.wait(e.retry_after):
+                    return
+                self._queue.put(item)
+            except telegram.error.TelegramError as e:
+                self.failed += 1
+                logging.error(f'Ошибка при отправке подписки в чат {chat_id}: {e}')
+
+
+class SubscriptionScheduler:
+    """Рассылает ежедневные прогнозы подписчикам
+
+    Раз в минуту выбирает подписки на текущее время по UTC (время подписки
+    переведено в UTC по часовому поясу города), группирует их по городу,
+    запрашивает прогноз один раз на город и ставит сообщения в SendQueue.
+    Если смещение часового пояса в прогнозе (timezone) изменилось, время
+    рассылки подписок города пересчитывается: после перехода на летнее или
+    зимнее время прогноз приходит в то же местное время.
+    Работает в своем потоке и не занимает потоки Dispatcher.
+    """
+
+    def __init__(self, subscriptions, fetch, render, send_queue, fetch_workers=8):
+        self.subscriptions = subscriptions
+        self.fetch = fetch
+        self.render = render
+        self.send_queue = send_queue
+        self.fetch_workers = fetch_workers
+        self._stop = threading.Event()
+        self._thread = None
+        self._pool = ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix='subscription-fetch')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='subscription-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._pool.shutdown()
+
+    def _run(self):
+        last_minute = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        while not self._stop.wait(60 - datetime.now(timezone.utc).second):
+            now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+            # Если поток отстал, догоняем пропущенные минуты по порядку
+            minute = last_minute + timedelta(minutes=1)
+            while minute <= now:
+                try:
+                    self.run_window(minute.strftime('%H:%M'))
+                except Exception as e:
+                    logging.error(f'Ошибка рассылки подписок на {minute:%H:%M}: {e}')
+                minute += timedelta(minutes=1)
+            last_minute = now
+
+    def run_window(self, send_time):
+        """Рассылает прогнозы всем подписчикам на время send_time (HH:MM по UTC)"""
+        groups = self.subscriptions.due(send_time)
+        if not groups:
+            return 0
+
+        def deliver(item):
+            city_key, (city, chat_ids) = item
+            try:
+                series = self.fetch(city)
+                text = self.render(city, series)
+            except Exception as e:
+                logging.error(f'Не удалось подготовить прогноз для города {city}: {e}')
+                return 0
+            self._follow_offset(city_key, city, series)
+            if text is None:
+                return 0
+            for chat_id in chat_ids:
+                self.send_queue.put(chat_id, text)
+            return len(chat_ids)
+
+        queued = sum(self._pool.map(deliver, groups.items()))
+        logging.info(f'Подписки на {send_time}: {len(groups)} городов, {queued} сообщений в очереди')
+        return queued
+
+    def _follow_offset(self, city_key, city, series):
+        offset = getattr(series, 'timezone', None)
+        if offset is None:
+            return
+        try:
+            updated = self.subscriptions.update_offset(city_key, offset)
+        except sqlite3.Error as e:
+            logging.error(f'Не удалось обновить часовой пояс подписок на город {city}: {e}')
+            return
+        if updated:
+            logging.info(f'Часовой пояс города {city} сменился на {offset} с от UTC: обновлено {updated} подписок')
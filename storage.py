@@ -0,0 +1,492 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+
+# Миграции схемы по порядку; номер последней примененной хранится в PRAGMA user_version.
+# Первая миграция создает таблицы с IF NOT EXISTS, чтобы принять базы, созданные до миграций.
+MIGRATIONS = [
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            is_registered INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            city TEXT NOT NULL,
+            city_key TEXT NOT NULL,
+            send_time TEXT NOT NULL,
+            PRIMARY KEY (user_id, city_key)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_send_time ON subscriptions (send_time)',
+    ],
+    [
+        'ALTER TABLE users ADD COLUMN default_city TEXT',
+        'ALTER TABLE users ADD COLUMN units TEXT',
+        'ALTER TABLE users ADD COLUMN lang TEXT',
+    ],
+    [
+        # Время рассылки хранится и в UTC: планировщик не зависит от часового пояса сервера.
+        # Подписки, созданные раньше, рассылались по времени сервера - переводим его в UTC
+        'ALTER TABLE subscriptions ADD COLUMN utc_offset INTEGER',
+        'ALTER TABLE subscriptions ADD COLUMN send_time_utc TEXT',
+        "UPDATE subscriptions SET send_time_utc = strftime('%H:%M', '2000-01-01 ' || send_time, 'utc')",
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_send_time_utc ON subscriptions (send_time_utc)',
+    ],
+    [
+        # Смещение часового пояса обновляется для всех подписчиков города сразу
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_city_key ON subscriptions (city_key)',
+    ],
+]
+
+
+class Database:
+    """Долгоживущие соединения с SQLite в режиме WAL, по одному на поток
+
+    Соединения завершившихся потоков закрываются при создании следующего
+    соединения, поэтому их число не превышает числа живых потоков.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._migrated = False
+
+    def connection(self):
+        """Соединение текущего потока; создается при первом обращении"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._lock:
+                for thread in [thread for thread in self._connections if not thread.is_alive()]:
+                    self._connections.pop(thread).close()
+                self._connections[threading.current_thread()] = conn
+        return conn
+
+    def open_connections(self):
+        with self._lock:
+            return len(self._connections)
+
+    def migrate(self):
+        """Применяет недостающие миграции схемы; возвращает номер версии схемы
+
+        Миграции выполняются под BEGIN IMMEDIATE, поэтому процессы, открывшие
+        базу одновременно, применяют каждую ровно один раз.
+        """
+        with self._lock:
+            if self._migrated:
+                return len(MIGRATIONS)
+        conn = self.connection()
+        with metrics.db_operation('migrate'):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                (version,) = conn.execute('PRAGMA user_version').fetchone()
+                for number in range(version, len(MIGRATIONS)):
+                    for statement in MIGRATIONS[number]:
+                        conn.execute(statement)
+                    logging.info(f'Применена миграция схемы базы данных {number + 1}')
+                conn.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        with self._lock:
+            self._migrated = True
+        return len(MIGRATIONS)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class UserStore:
+    """Хранилище пользователей
+
+    Множество зарегистрированных пользователей держится в памяти, поэтому
+    проверка регистрации не обращается к диску. При batch_size > 1 новые
+    регистрации копятся в буфере и записываются пачками.
+    """
+
+    def __init__(self, database, batch_size=1, flush_interval=1.0):
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._known = set()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+
+    def open(self):
+        """Обновляет схему, загружает известных пользователей и запускает фоновую запись"""
+        self.database.migrate()
+        conn = self.database.connection()
+        with metrics.db_operation('load_users'):
+            rows = conn.execute('SELECT user_id FROM users WHERE is_registered = 1').fetchall()
+        with self._lock:
+            self._known.update(user_id for (user_id,) in rows)
+
+        if self.batch_size > 1 and self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='user-store-flush', daemon=True)
+            self._flusher.start()
+
+    def is_registered(self, user_id):
+        with self._lock:
+            return user_id in self._known
+
+    def register(self, user_id, username):
+        """Регистрирует пользователя; возвращает True, если он не был зарегистрирован раньше"""
+        with self._lock:
+            if user_id in self._known:
+                return False
+            self._known.add(user_id)
+            if self.batch_size > 1:
+                self._pending.append((user_id, username))
+                flush_now = len(self._pending) >= self.batch_size
+            else:
+                flush_now = False
+
+        if self.batch_size > 1:
+            if flush_now:
+                self.flush()
+            return True
+
+        try:
+            return self._upsert([(user_id, username)]) > 0
+        except sqlite3.Error:
+            with self._lock:
+                self._known.discard(user_id)
+            raise
+
+    def flush(self):
+        """Записывает накопленные регистрации одной транзакцией"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                self._upsert(batch)
+            except sqlite3.Error as e:
+                logging.error(f'Ошибка при записи пользователей в базу данных: {e}')
+                with self._lock:
+                    self._pending[:0] = batch
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def _upsert(self, rows):
+        # Один запрос вместо проверки и вставки: повторная регистрация ничего не меняет
+        conn = self.database.connection()
+        with metrics.db_operation('upsert_users'), conn:
+            before = conn.total_changes
+            conn.executemany('''
+                INSERT INTO users (user_id, username, is_registered) VALUES (?, ?, 1)
+                ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, is_registered = 1
+                WHERE users.is_registered = 0
+            ''', rows)
+            return conn.total_changes - before
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+Profile = namedtuple('Profile', ('city', 'units', 'lang'))
+Profile.__doc__ = '''Настройки пользователя; None - используется значение бота по умолчанию'''
+
+EMPTY_PROFILE = Profile(None, None, None)
+
+
+class ProfileStore:
+    """Настройки пользователей: город по умолчанию, единицы и язык
+
+    Настройки загружаются лениво, при первой команде пользователя, и дальше
+    берутся из памяти. Профиль хранится одним целым числом: номер города в
+    таблице интернированных названий, номер языка и номер единиц. Пользователь
+    без настроек тоже запоминается, поэтому его команды не обращаются к диску.
+    Сверх max_size из памяти вытесняются самые давно загруженные профили без
+    незаписанных изменений. Изменения копятся и записываются фоновым потоком;
+    записываются только измененные поля, чтобы не затереть изменения,
+    сделанные другим процессом.
+
+    При заданном ttl профиль без незаписанных изменений перечитывается из базы
+    через ttl секунд после загрузки: в режиме webhook команды одного
+    пользователя из разных чатов обрабатываются разными процессами. Время
+    загрузки хранится в младших битах того же числа.
+    """
+
+    UNITS = ('metric', 'imperial', 'standard')
+    FIELDS = Profile._fields
+    _UNITS_BITS = 2
+    _LANG_BITS = 6
+    _TIME_BITS = 32
+
+    def __init__(self, database, max_size=200000, flush_interval=1.0, ttl=None):
+        self.database = database
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+
+        self._profiles = {}
+        # Пользователь -> множество измененных, но еще не записанных полей
+        self._dirty = {}
+        self._origin = time.monotonic()
+        self._cities = [None]
+        self._city_ids = {}
+        self._langs = [None]
+        self._lang_ids = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+
+    def open(self):
+        self.database.migrate()
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='profile-store-flush', daemon=True)
+            self._flusher.start()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._profiles.get(user_id)
+            if entry is not None and not self._expired(user_id, entry):
+                return self._unpack(entry)
+
+        profile = self._load(user_id)
+        with self._lock:
+            # Пока профиль читался, его могли изменить: побеждает изменение
+            entry = self._profiles.get(user_id)
+            if entry is None or self._expired(user_id, entry):
+                # Перечитанный профиль переносится в конец: порядок словаря - порядок загрузки
+                self._profiles.pop(user_id, None)
+                entry = self._profiles[user_id] = self._pack(profile)
+                self._evict()
+            return self._unpack(entry)
+
+    def update(self, user_id, **changes):
+        """Меняет поля профиля (city, units, lang); возвращает новый профиль"""
+        units = changes.get('units')
+        if units is not None and units not in self.UNITS:
+            raise ValueError(f'Неизвестные единицы измерения: {units}')
+        current = self.get(user_id)
+        with self._lock:
+            entry = self._profiles.get(user_id)
+            profile = (current if entry is None else self._unpack(entry))._replace(**changes)
+            # Время загрузки сохраняется: остальные поля перечитываются по прежнему расписанию
+            packed = self._pack(profile, None if entry is None else self._loaded_at(entry))
+            if self._unpack(packed) != profile:
+                raise ValueError(f'Не удалось сохранить язык {profile.lang}: слишком много разных языков')
+            self._profiles[user_id] = packed
+            self._dirty.setdefault(user_id, set()).update(changes)
+        return profile
+
+    def flush(self):
+        """Записывает измененные профили одной транзакцией"""
+        with self._flush_lock:
+            with self._lock:
+                batch = {user_id: self._profiles[user_id] for user_id in self._dirty}
+                rows = [(user_id,) + tuple(self._unpack(packed))
+                        + tuple(field in self._dirty[user_id] for field in self.FIELDS)
+                        for user_id, packed in batch.items()]
+            if not rows:
+                return
+            try:
+                self._upsert(rows)
+            except sqlite3.Error as e:
+                # Профили остаются помеченными и будут записаны следующей попыткой
+                logging.error(f'Ошибка при записи настроек пользователей в базу данных: {e}')
+                return
+            with self._lock:
+                for user_id, packed in batch.items():
+                    if self._profiles.get(user_id) == packed:
+                        self._dirty.pop(user_id, None)
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._profiles), 'pending': len(self._dirty), 'cities': len(self._cities) - 1}
+
+    def _load(self, user_id):
+        with metrics.db_operation('load_profile'):
+            row = self.database.connection().execute(
+                'SELECT default_city, units, lang FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return EMPTY_PROFILE
+        city, units, lang = row
+        # Единицы, записанные в обход бота, считаются не заданными
+        return Profile(city, units if units in self.UNITS else None, lang)
+
+    def _pack(self, profile, loaded_at=None):
+        # Вызывается под self._lock. Язык сверх 2 ** _LANG_BITS разных не сохраняется
+        units = 0 if profile.units is None else self.UNITS.index(profile.units) + 1
+        lang = self._intern(self._langs, self._lang_ids, profile.lang, 1 << self._LANG_BITS)
+        city = self._intern(self._cities, self._city_ids, profile.city)
+        if loaded_at is None:
+            loaded_at = int(time.monotonic() - self._origin) & ((1 << self._TIME_BITS) - 1)
+        return ((city << self._LANG_BITS | lang) << self._UNITS_BITS | units) << self._TIME_BITS | loaded_at
+
+    def _loaded_at(self, packed):
+        return packed & ((1 << self._TIME_BITS) - 1)
+
+    def _expired(self, user_id, packed):
+        # Вызывается под self._lock; незаписанные изменения не перечитываются
+        if self.ttl is None or user_id in self._dirty:
+            return False
+        return int(time.monotonic() - self._origin) - self._loaded_at(packed) >= self.ttl
+
+    @staticmethod
+    def _intern(values, ids, value, limit=None):
+        """Номер значения в таблице values (0 - None); новое значение добавляется, если есть место"""
+        if value is None:
+            return 0
+        number = ids.get(value)
+        if number is None:
+            if limit is not None and len(values) >= limit:
+                return 0
+            number = ids[value] = len(values)
+            values.append(value)
+        return number
+
+    def _unpack(self, packed):
+        packed >>= self._TIME_BITS
+        units = packed & ((1 << self._UNITS_BITS) - 1)
+        packed >>= self._UNITS_BITS
+        lang = packed & ((1 << self._LANG_BITS) - 1)
+        city = packed >> self._LANG_BITS
+        return Profile(self._cities[city], self.UNITS[units - 1] if units else None, self._langs[lang])
+
+    def _evict(self):
+        # Вызывается под self._lock; словарь упорядочен по времени загрузки
+        excess = len(self._profiles) - self.max_size
+        if excess <= 0:
+            return
+        victims = []
+        for user_id in self._profiles:
+            if user_id not in self._dirty:
+                victims.append(user_id)
+                if len(victims) >= excess:
+                    break
+        for user_id in victims:
+            del self._profiles[user_id]
+
+    def _upsert(self, rows):
+        conn = self.database.connection()
+        with metrics.db_operation('upsert_profiles'), conn:
+            # Последние три параметра - признаки измененных полей; остальные поля строки не трогаем
+            conn.executemany('''
+                INSERT INTO users (user_id, default_city, units, lang) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    default_city = CASE WHEN ? THEN excluded.default_city ELSE users.default_city END,
+                    units = CASE WHEN ? THEN excluded.units ELSE users.units END,
+                    lang = CASE WHEN ? THEN excluded.lang ELSE users.lang END
+            ''', rows)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+def to_utc(send_time, utc_offset):
+    """Местное время ЧЧ:ММ при смещении utc_offset секунд -> время ЧЧ:ММ по UTC"""
+    hours, minutes = map(int, send_time.split(':'))
+    total = (hours * 60 + minutes - utc_offset // 60) % (24 * 60)
+    return f'{total // 60:02d}:{total % 60:02d}'
+
+
+class SubscriptionStore:
+    """Подписки пользователей на ежедневный прогноз
+
+    city_key - нормализованный ключ города, по которому подписчики
+    группируются, чтобы запрашивать прогноз один раз на город. send_time -
+    местное время города, utc_offset - смещение его часового пояса от UTC в
+    секундах на момент подписки; рассылка идет по send_time_utc.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def open(self):
+        self.database.migrate()
+
+    def subscribe(self, user_id, chat_id, city, city_key, send_time, utc_offset=0):
+        """Сохраняет подписку; send_time (ЧЧ:ММ) - местное время города со смещением utc_offset"""
+        conn = self.database.connection()
+        with metrics.db_operation('subscribe'), conn:
+            conn.execute('''
+                INSERT INTO subscriptions (user_id, chat_id, city, city_key, send_time, utc_offset, send_time_utc)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, city_key) DO UPDATE SET
+                    chat_id = excluded.chat_id, city = excluded.city, send_time = excluded.send_time,
+                    utc_offset = excluded.utc_offset, send_time_utc = excluded.send_time_utc
+            ''', (user_id, chat_id, city, city_key, send_time, utc_offset, to_utc(send_time, utc_offset)))
+
+    def unsubscribe(self, user_id, city_key=None):
+        """Удаляет подписку на город или все подписки пользователя; возвращает число удаленных"""
+        conn = self.database.connection()
+        with metrics.db_operation('unsubscribe'), conn:
+            if city_key is None:
+                cursor = conn.execute('DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
+            else:
+                cursor = conn.execute('DELETE FROM subscriptions WHERE user_id = ? AND city_key = ?',
+                                      (user_id, city_key))
+            return cursor.rowcount
+
+    def update_offset(self, city_key, utc_offset):
+        """Переводит подписки города на новое смещение от UTC (переход на летнее или зимнее время)
+
+        Местное время подписки сохраняется, пересчитывается время по UTC.
+        Подписки, созданные до хранения смещения, не меняются. Возвращает
+        число обновленных подписок.
+        """
+        conn = self.database.connection()
+        with metrics.db_operation('update_subscription_offset'), conn:
+            cursor = conn.execute('''
+                UPDATE subscriptions
+                SET utc_offset = ?, send_time_utc = strftime('%H:%M', '2000-01-01 ' || send_time, ?)
+                WHERE city_key = ? AND utc_offset IS NOT NULL AND utc_offset != ?
+            ''', (utc_offset, f'{-utc_offset} seconds', city_key, utc_offset))
+            return cursor.rowcount
+
+    def due(self, send_time):
+        """Подписки на время send_time по UTC, сгруппированные по городу: {city_key: (city, [chat_id, ...])}"""
+        conn = self.database.connection()
+        groups = {}
+        with metrics.db_operation('due_subscriptions'):
+            rows = conn.execute('SELECT city_key, city, chat_id FROM subscriptions WHERE send_time_utc = ?',
+                                (send_time,))
+            for city_key, city, chat_id in rows:
+                group = groups.get(city_key)
+                if group is None:
+                    group = groups[city_key] = (city, [])
+                group[1].append(chat_id)
+        return groups
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from benchmark import CITIES, FakeOpenWeatherMap
+from cache_backend import SQLiteCacheBackend
+from city_index import City
+from weather_cache import WeatherCache
+from weather_client import WeatherClient
+
+
+class SQLiteConnectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp(prefix='owm-test-')
+        self.backend = SQLiteCacheBackend(os.path.join(self.db_dir, 'cache.db'))
+        self.api = FakeOpenWeatherMap(CITIES[:3], latency_ms=0, jitter_ms=0).start()
+        self.client = WeatherClient(self.api.base_url, 'key', 'metric', 'ru',
+                                    cache=WeatherCache(600, 100, backend=self.backend))
+        ids = sorted(self.api.by_id)
+        self.cities = [City(city_id, name, 'RU', 0.0, 0.0) for city_id, name in zip(ids, CITIES)]
+
+    def tearDown(self):
+        self.client.close()
+        self.api.stop()
+        self.backend.close()
+        shutil.rmtree(self.db_dir)
+
+    def test_repeated_current_many_does_not_leak_connections(self):
+        self.client.current_many(self.cities, force=True)
+        opened = self.backend.database.open_connections()
+        for _ in range(30):
+            self.client.current_many(self.cities, force=True)
+        self.assertEqual(self.backend.database.open_connections(), opened)
+
+    def test_connections_of_finished_threads_are_closed(self):
+        for _ in range(20):
+            thread = threading.Thread(target=self.backend.get, args=(('weather', 'q', 'москва'),))
+            thread.start()
+            thread.join()
+        self.assertLessEqual(self.backend.database.open_connections(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
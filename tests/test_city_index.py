@@ -0,0 +1,97 @@
+import json
+import os
+import random
+import shutil
+import string
+import tempfile
+import time
+import unittest
+
+from city_index import CityIndex
+
+# Записи в том виде и порядке, в котором они встречаются в city.list.json OpenWeatherMap
+SAMPLE = [
+    {'id': 6058560, 'name': 'London', 'state': '', 'country': 'CA', 'coord': {'lon': -81.23304, 'lat': 42.983391}},
+    {'id': 2643743, 'name': 'London', 'state': '', 'country': 'GB', 'coord': {'lon': -0.12574, 'lat': 51.50853}},
+    {'id': 5601538, 'name': 'Moscow', 'state': 'ID', 'country': 'US', 'coord': {'lon': -117.000168, 'lat': 46.732391}},
+    {'id': 524894, 'name': 'Moskva', 'state': '', 'country': 'RU', 'coord': {'lon': 37.606667, 'lat': 55.761665}},
+    {'id': 524901, 'name': 'Moscow', 'state': '', 'country': 'RU', 'coord': {'lon': 37.615555, 'lat': 55.75222}},
+    {'id': 498817, 'name': 'Saint Petersburg', 'state': '', 'country': 'RU', 'coord': {'lon': 30.264168, 'lat': 59.894444}},
+    {'id': 1486209, 'name': 'Yekaterinburg', 'state': '', 'country': 'RU', 'coord': {'lon': 60.6122, 'lat': 56.8575}},
+    {'id': 4119617, 'name': 'Paris', 'state': 'AR', 'country': 'US', 'coord': {'lon': -93.729637, 'lat': 35.292030}},
+    {'id': 2988507, 'name': 'Paris', 'state': '', 'country': 'FR', 'coord': {'lon': 2.3488, 'lat': 48.853409}},
+]
+
+
+class CityIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def index(self, cities):
+        path = os.path.join(self.tmp, 'city.list.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(cities, f)
+        return CityIndex.open(path)
+
+    def test_cyrillic_and_latin_names_resolve_to_one_city(self):
+        index = self.index(SAMPLE)
+        ids = {index.resolve(text).id for text in ('москва', 'Москва ', 'Moscow', 'MOSCOW', 'Moskva')}
+        self.assertEqual(ids, {524901})
+        self.assertEqual(index.resolve('Санкт-Петербург').id, 498817)
+        self.assertEqual(index.resolve('Екатеринбург').id, 1486209)
+        self.assertEqual(index.resolve('Париж').id, 2988507)
+
+    def test_duplicate_names_prefer_capital_over_file_order(self):
+        index = self.index(SAMPLE)
+        self.assertEqual(index.resolve('London').id, 2643743)
+        self.assertEqual(index.resolve('London, CA').id, 6058560)
+        self.assertEqual(index.resolve('Moscow, US').id, 5601538)
+
+    def test_duplicate_names_prefer_larger_population(self):
+        cities = [
+            {'id': 1, 'name': 'Springfield', 'country': 'US', 'coord': {'lon': 0, 'lat': 0}, 'stat': {'population': 60000}},
+            {'id': 2, 'name': 'Springfield', 'country': 'US', 'coord': {'lon': 0, 'lat': 0}, 'stat': {'population': 160000}},
+        ]
+        self.assertEqual(self.index(cities).resolve('Springfield').id, 2)
+
+    def test_prefix_prefers_best_ranked_match(self):
+        cities = SAMPLE + [
+            {'id': 3174741, 'name': 'Londa', 'country': 'IT', 'coord': {'lon': 11.56, 'lat': 43.86}},
+            {'id': 1504826, 'name': 'Kazachinskoye', 'country': 'RU', 'coord': {'lon': 93.14, 'lat': 57.7}},
+            {'id': 551487, 'name': 'Kazan', 'country': 'RU', 'coord': {'lon': 49.12, 'lat': 55.79}},
+        ]
+        index = self.index(cities)
+        self.assertEqual(index.resolve('Lond').id, 2643743)
+        self.assertEqual(index.resolve('Lond, CA').id, 6058560)
+        self.assertEqual(index.resolve('Каза').id, 551487)
+        self.assertEqual(index.resolve('Kazach').id, 1504826)
+
+    def test_ambiguous_prefix_is_not_resolved(self):
+        cities = [{'id': i, 'name': f'Sanxx {i:04d}', 'country': 'XX', 'coord': {'lon': 0, 'lat': 0}}
+                  for i in range(1000)]
+        self.assertIsNone(self.index(cities).resolve('Sanxx'))
+
+    def test_fuzzy_match(self):
+        index = self.index(SAMPLE)
+        self.assertEqual(index.resolve('Yekaterinbrug').id, 1486209)
+        self.assertIsNone(index.resolve('Атлантида'))
+
+    def test_fuzzy_miss_is_bounded_on_large_list(self):
+        rng = random.Random(0)
+        cities = list(SAMPLE)
+        for i in range(60000):
+            # Общие первые буквы дают тысячи кандидатов одной длины для нечеткого поиска
+            name = 'Sa' + ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 12)))
+            cities.append({'id': 10 ** 7 + i, 'name': name, 'country': 'XX', 'coord': {'lon': 0, 'lat': 0}})
+        index = self.index(cities)
+        started = time.perf_counter()
+        for _ in range(10):
+            index.resolve('Saqqqqqqqqzz')
+        self.assertLess((time.perf_counter() - started) / 10, 0.005)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+from forecast_store import ROLL_RETRY_SECONDS, STEP_SECONDS, ForecastStore
+
+NOW = 1700049600 + 600
+
+
+def forecast(first_dt):
+    items = [{'dt': first_dt + step * STEP_SECONDS, 'main': {'temp': 1.0 + step},
+              'weather': [{'description': 'ясно'}]} for step in range(8)]
+    return {'cod': '200', 'list': items, 'city': {'name': 'Москва', 'timezone': 10800}}
+
+
+class FakeClient:
+    """Отдает один и тот же ряд, как OpenWeatherMap, еще не сдвинувший его"""
+
+    def __init__(self, first_dt):
+        self.first_dt = first_dt
+        self.calls = 0
+
+    def location_key(self, city, units=None, lang=None):
+        return ('q', city, units or 'metric', lang or 'ru')
+
+    def forecast(self, city, units=None, lang=None):
+        self.calls += 1
+        return forecast(self.first_dt)
+
+
+class ForecastStoreTest(unittest.TestCase):
+    def get(self, store, now):
+        import forecast_store
+        original = forecast_store.time.time
+        forecast_store.time.time = lambda: now
+        try:
+            return store.get('москва')
+        finally:
+            forecast_store.time.time = original
+
+    def test_series_is_reused_until_first_step(self):
+        client = FakeClient(NOW + 1800)
+        store = ForecastStore(client)
+        self.get(store, NOW)
+        self.get(store, NOW + 1000)
+        self.assertEqual(client.calls, 1)
+        self.get(store, NOW + 1800)
+        self.assertEqual(client.calls, 2)
+
+    def test_series_not_rolled_by_upstream_is_not_refetched_on_every_request(self):
+        # Первый шаг уже наступил, но API все еще отдает ряд, начинающийся с него
+        client = FakeClient(NOW - 600)
+        store = ForecastStore(client)
+        series = self.get(store, NOW)
+        for offset in (1, 60, ROLL_RETRY_SECONDS - 1):
+            self.get(store, NOW + offset)
+        self.assertEqual(client.calls, 1)
+        self.assertFalse(series.is_stale(now=NOW + 60))
+        self.assertEqual(series.refresh_at(STEP_SECONDS, 30), NOW + ROLL_RETRY_SECONDS)
+        self.get(store, NOW + ROLL_RETRY_SECONDS)
+        self.assertEqual(client.calls, 2)
+
+    def test_refresh_at_respects_min_gap(self):
+        client = FakeClient(NOW + 60)
+        store = ForecastStore(client)
+        self.get(store, NOW)
+        self.assertEqual(store.refresh_at('москва', 30), NOW + 60)
+        self.assertEqual(store.refresh_at('москва', 30, min_gap=600), NOW + 600)
+        self.assertIsNone(store.refresh_at('питер', 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+import unittest
+
+from metrics import Registry
+
+
+class RegistryTest(unittest.TestCase):
+    def test_callback_counter_is_exported_as_counter(self):
+        registry = Registry()
+        hits = [3]
+        registry.callback_counter('cache_hits_total', 'Попадания в кэш', lambda: hits[0])
+        registry.gauge('cache_size', 'Записей в кэше', lambda: 2)
+        hits[0] = 5
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE cache_hits_total counter', lines)
+        self.assertIn('cache_hits_total 5', lines)
+        self.assertIn('# TYPE cache_size gauge', lines)
+        self.assertIn('cache_size 2', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import string
+import unittest
+
+from rendering import MESSAGES, Renderer
+
+
+class MessagesTest(unittest.TestCase):
+    def test_languages_have_same_messages_and_placeholders(self):
+        def fields(template):
+            return {name for _, name, _, _ in string.Formatter().parse(template) if name}
+
+        reference = MESSAGES['ru']
+        for lang, messages in MESSAGES.items():
+            self.assertEqual(set(messages), set(reference), lang)
+            for kind, template in messages.items():
+                self.assertEqual(fields(template), fields(reference[kind]), f'{lang}.{kind}')
+
+    def test_text_uses_requested_language(self):
+        renderer = Renderer()
+        self.assertIn('/weather London', renderer.text('usage_city', 'en', 'metric', command='weather'))
+        self.assertIn('/forecast Москва', renderer.text('usage_city', 'ru', 'metric', command='forecast'))
+        # Языки, на которые бот не переведен, получают ответы на английском
+        self.assertEqual(renderer.text('unsubscribed', 'de', 'metric'), 'Subscription cancelled.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from scheduler import SendQueue, SubscriptionScheduler
+from storage import Database, SubscriptionStore, to_utc
+
+
+class SubscriptionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp(prefix='owm-test-')
+        self.path = os.path.join(self.db_dir, 'users.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def test_to_utc(self):
+        self.assertEqual(to_utc('07:30', 3 * 3600), '04:30')
+        self.assertEqual(to_utc('01:00', 3 * 3600), '22:00')
+        self.assertEqual(to_utc('22:15', -5 * 3600), '03:15')
+        self.assertEqual(to_utc('07:30', 5 * 3600 + 1800), '02:00')
+
+    def test_due_uses_utc_time(self):
+        database = Database(self.path)
+        store = SubscriptionStore(database)
+        store.open()
+        store.subscribe(1, 10, 'Москва', 'id:524901', '07:30', 3 * 3600)
+        store.subscribe(2, 20, 'London', 'id:2643743', '04:30', 0)
+        groups = store.due('04:30')
+        database.close()
+        self.assertEqual(groups, {'id:524901': ('Москва', [10]), 'id:2643743': ('London', [20])})
+
+    def test_update_offset_keeps_local_time(self):
+        database = Database(self.path)
+        store = SubscriptionStore(database)
+        store.open()
+        store.subscribe(1, 10, 'Берлин', 'id:2950159', '07:30', 3600)
+        store.subscribe(2, 20, 'Нью-Йорк', 'id:5128581', '22:15', -4 * 3600)
+        self.assertEqual(store.update_offset('id:2950159', 3600), 0)
+        self.assertEqual(store.update_offset('id:2950159', 7200), 1)
+        self.assertEqual(store.update_offset('id:5128581', -5 * 3600 + 1800), 1)
+        groups = store.due(to_utc('07:30', 7200)), store.due(to_utc('22:15', -5 * 3600 + 1800))
+        database.close()
+        self.assertEqual(groups[0], {'id:2950159': ('Берлин', [10])})
+        self.assertEqual(groups[1], {'id:5128581': ('Нью-Йорк', [20])})
+
+    def test_scheduler_follows_timezone_change(self):
+        database = Database(self.path)
+        store = SubscriptionStore(database)
+        store.open()
+        store.subscribe(1, 10, 'Берлин', 'id:2950159', '07:30', 3600)
+        sent = []
+        scheduler = SubscriptionScheduler(
+            store,
+            fetch=lambda city: SimpleNamespace(timezone=7200),
+            render=lambda city, series: f'Прогноз для {city}',
+            send_queue=SimpleNamespace(put=lambda chat_id, text: sent.append(chat_id)),
+        )
+        self.assertEqual(scheduler.run_window('06:30'), 1)
+        scheduler.stop()
+        groups = store.due('05:30'), store.due('06:30')
+        database.close()
+        self.assertEqual(sent, [10])
+        self.assertEqual(groups, ({'id:2950159': ('Берлин', [10])}, {}))
+
+    def test_migration_keeps_server_time_of_old_subscriptions(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('''CREATE TABLE subscriptions (user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL,
+                        city TEXT NOT NULL, city_key TEXT NOT NULL, send_time TEXT NOT NULL,
+                        PRIMARY KEY (user_id, city_key))''')
+        conn.execute("INSERT INTO subscriptions VALUES (1, 10, 'Москва', 'москва', '07:30')")
+        conn.commit()
+        (expected,) = conn.execute("SELECT strftime('%H:%M', '2000-01-01 07:30', 'utc')").fetchone()
+        conn.close()
+
+        database = Database(self.path)
+        store = SubscriptionStore(database)
+        store.open()
+        # Для старых подписок неизвестно местное время города: смещение к ним не применяется
+        self.assertEqual(store.update_offset('москва', 10800), 0)
+        groups = store.due(expected)
+        database.close()
+        self.assertEqual(groups, {'москва': ('Москва', [10])})
+
+
+class SlowBot:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text):
+        self.sent.append(chat_id)
+
+
+class SendQueueTest(unittest.TestCase):
+    def test_stop_drains_queue(self):
+        bot = SlowBot()
+        send_queue = SendQueue(bot, rate=1000)
+        send_queue.start()
+        for chat_id in range(20):
+            send_queue.put(chat_id, 'text')
+        send_queue.stop(timeout=5)
+        self.assertEqual(bot.sent, list(range(20)))
+
+    def test_stop_is_bounded_by_timeout(self):
+        bot = SlowBot()
+        send_queue = SendQueue(bot, rate=5, capacity=1)
+        send_queue.start()
+        for chat_id in range(1000):
+            send_queue.put(chat_id, 'text')
+        started = time.monotonic()
+        send_queue.stop(timeout=0.3)
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertLess(len(bot.sent), 10)
+        # Поток завершается, дождавшись токена, и не отправляет отброшенные сообщения
+        for thread in threading.enumerate():
+            if thread.name == 'send-queue':
+                thread.join(1.0)
+                self.assertFalse(thread.is_alive())
+        self.assertLess(len(bot.sent), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import Database, Profile, ProfileStore
+
+
+class ProfileStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp(prefix='owm-test-')
+        self.database = Database(os.path.join(self.db_dir, 'users.db'))
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.database.close()
+        shutil.rmtree(self.db_dir)
+
+    def store(self, ttl=None):
+        # Как воркеры webhook: у каждого процесса свой ProfileStore над общей базой
+        store = ProfileStore(self.database, flush_interval=3600, ttl=ttl)
+        store.open()
+        self.stores.append(store)
+        return store
+
+    def row(self, user_id):
+        return self.database.connection().execute(
+            'SELECT default_city, units, lang FROM users WHERE user_id = ?', (user_id,)).fetchone()
+
+    def test_update_in_one_store_does_not_revert_another(self):
+        first, second = self.store(), self.store()
+        first.get(1)
+        second.get(1)
+        first.update(1, lang='en')
+        first.flush()
+        second.update(1, units='imperial')
+        second.flush()
+        self.assertEqual(self.row(1), (None, 'imperial', 'en'))
+
+    def test_cached_profile_is_reloaded_after_ttl(self):
+        first, second = self.store(), self.store(ttl=0)
+        self.assertEqual(second.get(1), Profile(None, None, None))
+        first.update(1, city='Москва', lang='en')
+        first.flush()
+        self.assertEqual(second.get(1), Profile('Москва', None, 'en'))
+
+    def test_unflushed_changes_are_not_reloaded(self):
+        store = self.store(ttl=0)
+        store.update(1, units='imperial')
+        self.assertEqual(store.get(1), Profile(None, 'imperial', None))
+        store.flush()
+        self.assertEqual(store.get(1), Profile(None, 'imperial', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
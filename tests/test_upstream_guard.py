@@ -0,0 +1,183 @@
+import time
+import unittest
+
+import requests
+
+from rate_limit import TokenBucket
+from upstream_guard import (CircuitBreaker, CircuitOpenError, ConcurrencyLimitError, RateLimitedError,
+                            UpstreamGuard)
+
+
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.exceptions.HTTPError(f'{status}', response=response)
+
+
+def failing(*errors):
+    """fn для UpstreamGuard.call: по очереди бросает errors, затем возвращает 'ok'"""
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'ok'
+
+    fn.calls = calls
+    return fn
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_capacity_limits_burst(self):
+        bucket = TokenBucket(rate=1, capacity=3)
+        self.assertEqual([bucket.try_acquire() for _ in range(4)], [True, True, True, False])
+
+    def test_refills_over_time(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        time.sleep(0.05)
+        self.assertTrue(bucket.try_acquire())
+
+    def test_acquire_gives_up_without_waiting_when_timeout_is_too_short(self):
+        bucket = TokenBucket(rate=0.1, capacity=1)
+        bucket.try_acquire()
+        started = time.monotonic()
+        self.assertFalse(bucket.acquire(timeout=1.0))
+        self.assertLess(time.monotonic() - started, 0.1)
+
+    def test_acquire_waits_for_token(self):
+        bucket = TokenBucket(rate=20, capacity=1)
+        bucket.try_acquire()
+        self.assertTrue(bucket.acquire(timeout=1.0))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_single_probe_after_reset_timeout(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        breaker.allow()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_release_frees_probe_of_current_thread(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.release()
+        self.assertTrue(breaker.allow())
+
+
+class UpstreamGuardTest(unittest.TestCase):
+    def guard(self, retries=2, threshold=5, reset=30.0, bucket=None, rate_wait=0.2):
+        return UpstreamGuard(bucket or TokenBucket(1000, 1000), CircuitBreaker(threshold, reset),
+                             retries=retries, backoff_base=0.001, backoff_max=0.002, rate_wait=rate_wait)
+
+    def deadline(self, seconds=5.0):
+        return time.monotonic() + seconds
+
+    def test_retries_transient_errors(self):
+        fn = failing(requests.exceptions.ConnectionError(), http_error(503))
+        self.assertEqual(self.guard().call('weather', fn, self.deadline()), 'ok')
+        self.assertEqual(len(fn.calls), 3)
+
+    def test_gives_up_after_retries(self):
+        fn = failing(*[requests.exceptions.Timeout()] * 3)
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.guard(retries=1).call('weather', fn, self.deadline())
+        self.assertEqual(len(fn.calls), 2)
+
+    def test_client_errors_are_not_retried(self):
+        guard = self.guard()
+        fn = failing(http_error(404))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            guard.call('weather', fn, self.deadline())
+        self.assertEqual(len(fn.calls), 1)
+        self.assertEqual(guard.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_retry_after_beyond_deadline_is_not_awaited(self):
+        fn = failing(http_error(429, {'Retry-After': '10'}))
+        started = time.monotonic()
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.guard().call('weather', fn, self.deadline(1.0))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(len(fn.calls), 1)
+
+    def test_open_circuit_rejects_without_calling(self):
+        guard = self.guard(retries=0, threshold=1)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            guard.call('weather', failing(requests.exceptions.ConnectionError()), self.deadline())
+        fn = failing()
+        with self.assertRaises(CircuitOpenError):
+            guard.call('weather', fn, self.deadline())
+        self.assertEqual(fn.calls, [])
+
+    def test_probe_is_released_after_unexpected_error(self):
+        guard = self.guard(retries=0, threshold=2, reset=0.1)
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                guard.call('weather', failing(requests.exceptions.ConnectionError()), self.deadline())
+        time.sleep(0.15)
+        # 200 с HTML вместо JSON: response.json() бросает ValueError
+        with self.assertRaises(ValueError):
+            guard.call('weather', failing(ValueError('not json')), self.deadline())
+        self.assertEqual(guard.call('weather', failing(), self.deadline()), 'ok')
+        self.assertEqual(guard.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_probe_is_released_after_concurrency_limit(self):
+        guard = self.guard(retries=0, threshold=1, reset=0.05)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            guard.call('weather', failing(requests.exceptions.ConnectionError()), self.deadline())
+        time.sleep(0.1)
+        with self.assertRaises(ConcurrencyLimitError):
+            guard.call('weather', failing(ConcurrencyLimitError()), self.deadline())
+        self.assertEqual(guard.call('weather', failing(), self.deadline()), 'ok')
+
+    def test_probe_in_flight_does_not_spend_tokens(self):
+        bucket = TokenBucket(rate=0.001, capacity=3)
+        guard = self.guard(retries=0, threshold=1, reset=0.01, bucket=bucket)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            guard.call('weather', failing(requests.exceptions.ConnectionError()), self.deadline())
+        time.sleep(0.02)
+        self.assertTrue(guard.breaker.allow())
+        self.assertTrue(guard.breaker.is_open())
+        for _ in range(3):
+            with self.assertRaises(CircuitOpenError):
+                guard.call('weather', failing(), self.deadline())
+        # Пока выполняется проба, токены остаются для запросов после ее успеха
+        self.assertTrue(bucket.try_acquire(2))
+
+    def test_rate_limit_fails_fast(self):
+        bucket = TokenBucket(rate=0.1, capacity=1)
+        bucket.try_acquire()
+        guard = self.guard(bucket=bucket, rate_wait=0.05)
+        started = time.monotonic()
+        with self.assertRaises(RateLimitedError):
+            guard.call('weather', failing(), self.deadline(10.0))
+        self.assertLess(time.monotonic() - started, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
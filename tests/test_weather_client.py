@@ -0,0 +1,34 @@
+import unittest
+
+from benchmark import CITIES, FakeOpenWeatherMap
+from city_index import City
+from rendering import Renderer, format_time
+from weather_cache import WeatherCache
+from weather_client import WeatherClient
+
+
+class GroupTest(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeOpenWeatherMap(CITIES[:3], latency_ms=0, jitter_ms=0).start()
+        self.client = WeatherClient(self.api.base_url, 'key', 'metric', 'ru', cache=WeatherCache(600, 100))
+        ids = sorted(self.api.by_id)
+        self.cities = [City(city_id, name, 'RU', 0.0, 0.0) for city_id, name in zip(ids, CITIES)]
+
+    def tearDown(self):
+        self.client.close()
+        self.api.stop()
+
+    def test_group_items_keep_city_timezone_in_cache(self):
+        results = self.client.current_many(self.cities)
+        self.assertEqual(self.api.calls, {'group': 1})
+        cached = self.client.current(self.cities[0])
+        self.assertEqual(self.api.calls, {'group': 1})
+        self.assertEqual(cached['cod'], 200)
+        self.assertEqual(cached['timezone'], results[0]['sys']['timezone'])
+        self.assertNotEqual(cached['timezone'], 0)
+        message = Renderer().current('sunrise', 'Москва', cached, 'ru', 'metric')
+        self.assertIn(format_time(cached['sys']['sunrise'], 10800), message)
+
+
+if __name__ == '__main__':
+    unittest.main()
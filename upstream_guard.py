@@ -0,0 +1,173 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+
+import metrics
+
+
+class UpstreamUnavailableError(requests.exceptions.RequestException):
+    """Запрос к OpenWeatherMap не выполнялся: сработала защита от перегрузки"""
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    pass
+
+
+class RateLimitedError(UpstreamUnavailableError):
+    pass
+
+
+class ConcurrencyLimitError(UpstreamUnavailableError):
+    """Все слоты клиента заняты до истечения дедлайна"""
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold ошибок подряд и через reset_timeout пропускает один пробный запрос"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_thread = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """Запрос сейчас будет отклонен: время ожидания еще не прошло или пробный запрос уже выполняется"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                return self._probe_in_flight
+            return self.state == self.OPEN and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                self._probe_thread = threading.get_ident()
+                return True
+            return False
+
+    def release(self):
+        """Снимает пробный запрос текущего потока, если он завершился, ничего не сказав о состоянии API
+
+        Без этого проба, прерванная, например, некорректным JSON, оставила бы
+        breaker полуоткрытым и отклоняющим все запросы до перезапуска.
+        """
+        with self._lock:
+            if self._probe_in_flight and self._probe_thread == threading.get_ident():
+                self._probe_in_flight = False
+                self._probe_thread = None
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info('Связь с OpenWeatherMap восстановлена')
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning(f'OpenWeatherMap недоступен, запросы приостановлены на {self.reset_timeout} с')
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+
+def _is_retryable(error):
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamGuard:
+    """Общая защита запросов к OpenWeatherMap
+
+    Ограничивает частоту запросов token bucket'ом по тарифу API, повторяет
+    идемпотентные GET с экспоненциальной задержкой и случайным разбросом,
+    а при серии сбоев размыкает circuit breaker, чтобы запросы сразу
+    завершались ошибкой, а не ждали таймаута.
+    """
+
+    def __init__(self, bucket, breaker, retries=2, backoff_base=0.2, backoff_max=2.0, rate_wait=0.2):
+        self.bucket = bucket
+        self.breaker = breaker
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Сверх rate_wait секунд токен не ждем: поток обработки команд не должен простаивать до дедлайна
+        self.rate_wait = rate_wait
+
+    def call(self, endpoint, fn, deadline):
+        """Выполняет fn() с учетом лимитов, повторов и дедлайна (time.monotonic())"""
+        attempt = 0
+        while True:
+            # Токен берем до пробного запроса breaker'а, чтобы не занять пробу впустую,
+            # и не берем, пока breaker отклоняет запросы (в том числе во время пробы)
+            if not self.breaker.is_open():
+                if not self.bucket.acquire(timeout=max(min(deadline - time.monotonic(), self.rate_wait), 0)):
+                    metrics.upstream_rejected_total.inc(endpoint, 'rate_limited')
+                    raise RateLimitedError(f'Исчерпан лимит запросов к /{endpoint}')
+            if not self.breaker.allow():
+                metrics.upstream_rejected_total.inc(endpoint, 'circuit_open')
+                raise CircuitOpenError(f'Запросы к /{endpoint} временно приостановлены')
+
+            try:
+                try:
+                    result = fn()
+                except UpstreamUnavailableError:
+                    # Запрос не дошел до API, о состоянии сервиса это ничего не говорит
+                    raise
+                except requests.exceptions.RequestException as e:
+                    if not _is_retryable(e):
+                        # Ответ 4xx означает, что сервис работает
+                        self.breaker.record_success()
+                        raise
+                    self.breaker.record_failure()
+                    error = e
+                else:
+                    self.breaker.record_success()
+                    return result
+            finally:
+                # Исход, не учтенный record_success или record_failure (ConcurrencyLimitError,
+                # ValueError от неразобранного ответа), не должен оставить пробу занятой
+                self.breaker.release()
+
+            delay = _retry_after(error)
+            if delay is None:
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            attempt += 1
+            if attempt > self.retries or time.monotonic() + delay >= deadline:
+                raise error
+            metrics.upstream_retries_total.inc(endpoint)
+            time.sleep(delay)
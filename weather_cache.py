@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_city(city):
+    """Приводит название города к каноничному виду для ключа кэша"""
+    return ' '.join(city.split()).casefold()
+
+
+class WeatherCache:
+    """Потокобезопасный LRU-кэш ответов OpenWeatherMap с ограниченным временем жизни
+
+    При заданном backend (см. cache_backend.py) кэш в памяти служит первым
+    уровнем: промахи проверяются в общем кэше, а новые значения записываются
+    в оба уровня под ключом (kind,) + key.
+    """
+
+    def __init__(self, ttl, max_size, backend=None, kind='weather'):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.backend = backend
+        self.kind = kind
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Возвращает сохраненное значение или None, если его нет или оно устарело
+
+        Обращение учитывается в популярности ключа в общем кэше, даже если
+        значение нашлось в памяти.
+        """
+        now = time.monotonic()
+        if self.backend is not None:
+            self.backend.count((self.kind,) + key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            # Устаревшая запись остается до вытеснения и может пригодиться get_stale()
+            self.misses += 1
+
+        if self.backend is None:
+            return None
+        shared = self.backend.get((self.kind,) + key)
+        if shared is None:
+            return None
+        value, expires_at = shared
+        self._store(key, value, now + expires_at - time.time())
+        return value
+
+    def get_stale(self, key):
+        """Возвращает значение независимо от срока жизни; для отдачи при недоступности API"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry[1]
+        if self.backend is None:
+            return None
+        shared = self.backend.get((self.kind,) + key, stale=True)
+        return shared[0] if shared is not None else None
+
+    def set(self, key, value):
+        """Сохраняет значение, вытесняя самые давно использованные записи"""
+        if self.ttl <= 0:
+            return
+        if self.backend is not None:
+            self.backend.set((self.kind,) + key, value, self.ttl)
+        self._store(key, value, time.monotonic() + self.ttl)
+
+    def expires_in(self, key):
+        """Секунды до истечения записи в памяти (отрицательные - уже истекла); None, если записи нет"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] - time.monotonic() if entry is not None else None
+
+    def _store(self, key, value, expires_at):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Возвращает счетчики попаданий, промахов и вытеснений"""
+        with self._lock:
+            stats = {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+        if self.backend is not None:
+            stats['backend'] = self.backend.stats()
+        return stats
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,246 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from city_index import City
+from singleflight import SingleFlight
+from upstream_guard import ConcurrencyLimitError
+from weather_cache import normalize_city
+
+
+class WeatherClient:
+    """Клиент OpenWeatherMap с общим пулом keep-alive соединений и ограничением параллелизма"""
+
+    # Максимум id в одном запросе /group
+    GROUP_SIZE = 20
+
+    def __init__(self, base_url, api_key, units, lang, cache=None,
+                 timeout=10, max_connections=20, max_concurrency=20, guard=None, stale_fallback=False,
+                 batch_workers=8):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.units = units
+        self.lang = lang
+        self.cache = cache
+        self.timeout = timeout
+        self.guard = guard
+        self.stale_fallback = stale_fallback
+        self.batch_workers = batch_workers
+
+        # Один Session на процесс: TCP/TLS соединения переиспользуются между командами
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._flight = SingleFlight()
+        # Один пул на клиент: потоки (и их соединения с общим кэшем) переживают вызов current_many
+        self._pool = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix='owm-batch')
+
+    def current(self, city, deadline=None, force=False, units=None, lang=None):
+        """Текущая погода; ответы с cod == 200 кэшируются
+
+        city - найденный в индексе City или название города строкой.
+        Если API недоступен и включен stale_fallback, возвращается последний
+        закэшированный ответ с пометкой 'stale': True. force=True - запросить
+        API, не заглядывая в кэш (фоновое обновление). units и lang заменяют
+        единицы и язык клиента для одного запроса.
+        """
+        params, location = self._location(city)
+        options = self._options(units, lang)
+        params = dict(params, units=options[0], lang=options[1])
+        key = location + options
+        if self.cache is not None and not force:
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+
+        def fetch():
+            data = self._get('weather', params, deadline)
+            if self.cache is not None and data.get('cod') == 200:
+                self.cache.set(key, data)
+            return data
+
+        try:
+            return self._coalesce(('weather',) + key, fetch, deadline)
+        except requests.exceptions.RequestException as e:
+            result = e if force else self._stale_or(key, e)
+            if result is e:
+                raise
+            return result
+
+    def current_many(self, cities, deadline=None, force=False, units=None, lang=None):
+        """Текущая погода для нескольких городов за минимум запросов к API
+
+        Сначала проверяется кэш. Найденные в индексе города запрашиваются
+        пачками по GROUP_SIZE через /group, остальные - параллельно через
+        current(). Возвращает список в порядке cities; на месте города,
+        для которого запрос не удался, стоит исключение.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+
+        options = self._options(units, lang)
+        results = [None] * len(cities)
+        by_id = {}
+        by_name = []
+        for i, city in enumerate(cities):
+            key = self.location_key(city, *options)
+            data = self.cache.get(key) if self.cache is not None and not force else None
+            if data is not None:
+                results[i] = data
+            elif isinstance(city, City):
+                by_id.setdefault(city.id, []).append(i)
+            else:
+                by_name.append(i)
+
+        ids = list(by_id)
+        chunks = [ids[start:start + self.GROUP_SIZE] for start in range(0, len(ids), self.GROUP_SIZE)]
+
+        def fetch_group(chunk):
+            try:
+                found = self._group(chunk, deadline, options)
+            except requests.exceptions.RequestException as e:
+                found = {}
+                for city_id in chunk:
+                    found[city_id] = e if force else self._stale_or(('id', city_id) + options, e)
+            for city_id in chunk:
+                for i in by_id[city_id]:
+                    results[i] = found.get(city_id, {'cod': '404', 'message': 'city not found'})
+
+        def fetch_one(i):
+            try:
+                results[i] = self.current(cities[i], deadline, force, *options)
+            except requests.exceptions.RequestException as e:
+                results[i] = e
+
+        tasks = [(fetch_group, chunk) for chunk in chunks] + [(fetch_one, i) for i in by_name]
+        for future in [self._pool.submit(fn, arg) for fn, arg in tasks]:
+            future.result()
+        return results
+
+    def forecast(self, city, deadline=None, units=None, lang=None):
+        """Прогноз на 5 дней с шагом 3 часа"""
+        params, location = self._location(city)
+        options = self._options(units, lang)
+        params = dict(params, units=options[0], lang=options[1])
+        key = location + options
+        return self._coalesce(('forecast',) + key,
+                              lambda: self._get('forecast', params, deadline), deadline)
+
+    def stats(self):
+        """Счетчики кэша и схлопнутых запросов"""
+        stats = {'coalesced': self._flight.stats()['coalesced']}
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+    def close(self):
+        self._pool.shutdown()
+        self.session.close()
+
+    def _group(self, city_ids, deadline, options):
+        """Один запрос /group для пачки id; ответы кэшируются как ответы /weather"""
+        units, lang = options
+        data = self._get('group', {'id': ','.join(map(str, city_ids)), 'units': units, 'lang': lang}, deadline)
+        found = {}
+        for item in data['list']:
+            # Элементы /group имеют формат /weather, но без поля cod, а смещение
+            # часового пояса лежит в sys.timezone, а не на верхнем уровне
+            item.setdefault('cod', 200)
+            item.setdefault('timezone', item.get('sys', {}).get('timezone', 0))
+            found[item['id']] = item
+            if self.cache is not None:
+                self.cache.set(('id', item['id']) + options, item)
+        return found
+
+    def popular_cities(self, n):
+        """Самые часто запрашиваемые города по данным общего кэша, для прогрева после запуска"""
+        backend = self.cache.backend if self.cache is not None else None
+        if backend is None or n <= 0:
+            return []
+        cities = []
+        for key, data in backend.top(self.cache.kind, n):
+            location, options = key[1:3], key[3:]
+            if options != (self.units, self.lang):
+                continue
+            if location[0] == 'id':
+                coord = data.get('coord', {})
+                cities.append(City(location[1], data.get('name', ''), data.get('sys', {}).get('country', ''),
+                                   coord.get('lat', 0.0), coord.get('lon', 0.0)))
+            else:
+                cities.append(location[1])
+        return cities
+
+    def _stale_or(self, key, error):
+        stale = self.cache.get_stale(key) if self.stale_fallback and self.cache is not None else None
+        if stale is None:
+            return error
+        metrics.stale_responses_total.inc('weather')
+        return dict(stale, stale=True)
+
+    def location_key(self, city, units=None, lang=None):
+        """Ключ города вместе с единицами и языком ответа"""
+        return self._location(city)[1] + self._options(units, lang)
+
+    def _options(self, units=None, lang=None):
+        """Единицы и язык запроса; не заданные берутся из настроек клиента"""
+        return units or self.units, lang or self.lang
+
+    @staticmethod
+    def _location(city):
+        """Параметры запроса и ключ кэша: по id для найденного города, иначе по названию"""
+        if isinstance(city, City):
+            return {'id': city.id}, ('id', city.id)
+        name = normalize_city(city)
+        return {'q': name}, ('q', name)
+
+    def _coalesce(self, key, fetch, deadline=None):
+        """Одинаковые одновременные запросы выполняются одним обращением к API"""
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        try:
+            with metrics.stage('fetch'):
+                return self._flight.do(key, fetch, timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            raise requests.exceptions.Timeout(f'Истек дедлайн ожидания запроса {key}')
+
+    def _get(self, endpoint, params, deadline=None):
+        """Выполняет GET-запрос через защиту от перегрузки API, если она задана"""
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        if self.guard is None:
+            return self._request(endpoint, params, deadline)
+        return self.guard.call(endpoint, lambda: self._request(endpoint, params, deadline), deadline)
+
+    def _request(self, endpoint, params, deadline):
+        """Один GET-запрос, укладывающийся в общий дедлайн (time.monotonic())"""
+        if not self._slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            raise ConcurrencyLimitError(f'Нет свободных слотов для запроса к /{endpoint}')
+        try:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.Timeout(f'Истек дедлайн запроса к /{endpoint}')
+
+            params = dict(params, appid=self.api_key)
+            try:
+                response = self.session.get(f'{self.base_url}/{endpoint}', params=params,
+                                            timeout=min(self.timeout, remaining))
+            except requests.exceptions.Timeout:
+                metrics.upstream_timeouts_total.inc(endpoint)
+                raise
+            except requests.exceptions.RequestException:
+                metrics.upstream_errors_total.inc(endpoint)
+                raise
+            metrics.upstream_responses_total.inc(endpoint, str(response.status_code))
+            response.raise_for_status()
+
+            with metrics.stage('parse'):
+                return response.json()
+        finally:
+            self._slots.release()
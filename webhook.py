@@ -0,0 +1,206 @@
+import hmac
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telegram
+
+import metrics
+
+updates_total = metrics.registry.counter(
+    'bot_webhook_updates_total', 'Обновления, принятые через webhook', ('status',))
+
+
+def shard_key(update):
+    """Ключ шардирования обновления: id чата, иначе id пользователя, иначе update_id
+
+    Все обновления одного чата получают один ключ и попадают в одну очередь,
+    поэтому обрабатываются строго по порядку.
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        sender = value.get('from')
+        if sender:
+            return sender['id']
+    return update.get('update_id', 0)
+
+
+class WebhookServer:
+    """HTTP-сервер, принимающий обновления Telegram и раскладывающий их по очередям воркеров
+
+    Всего processes * threads шардов: шард s обрабатывает поток s // processes
+    процесса s % processes. Если очередь процесса переполнена, сервер отвечает
+    503 и Telegram повторит доставку позже.
+    """
+
+    def __init__(self, host, port, path, secret, queues, threads, put_timeout=5.0):
+        self.path = path
+        self.secret = secret
+        self.queues = queues
+        self.threads = threads
+        self.put_timeout = put_timeout
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_port
+
+    def route(self, update):
+        """Номер процесса и потока, обрабатывающих обновление"""
+        shard = shard_key(update) % (len(self.queues) * self.threads)
+        return shard % len(self.queues), shard // len(self.queues)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='webhook-http', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Перестает принимать обновления; дожидается уже начатых запросов"""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _handler(self):
+        server = self
+
+        class UpdateHandler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                if self.path.split('?', 1)[0] != server.path:
+                    self.send_error(404)
+                    return
+                if server.secret and not hmac.compare_digest(
+                        self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), server.secret):
+                    updates_total.inc('forbidden')
+                    self.send_error(403)
+                    return
+
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    update = json.loads(self.rfile.read(length))
+                    process, thread = server.route(update)
+                except (ValueError, TypeError, AttributeError, KeyError) as e:
+                    logging.warning(f'Некорректное обновление от Telegram: {e}')
+                    updates_total.inc('invalid')
+                    self.send_error(400)
+                    return
+
+                try:
+                    server.queues[process].put((thread, update), timeout=server.put_timeout)
+                except queue.Full:
+                    updates_total.inc('overloaded')
+                    self.send_error(503)
+                    return
+
+                updates_total.inc('accepted')
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        return UpdateHandler
+
+
+def run_worker(index, updates, threads, setup):
+    """Процесс-воркер: обрабатывает обновления своих шардов обработчиками бота
+
+    setup(index, threads) возвращает Dispatcher с зарегистрированными
+    обработчиками и функцию освобождения ресурсов. Сигналы остановки
+    игнорируются: процесс завершается, когда главный процесс закроет очередь
+    и все принятые обновления будут обработаны.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    dispatcher, teardown = setup(index, threads)
+    # Обновления одного чата всегда попадают в одну локальную очередь и обрабатываются по порядку
+    local_queues = [queue.Queue() for _ in range(threads)]
+
+    def process(local_queue):
+        while True:
+            data = local_queue.get()
+            if data is None:
+                return
+            dispatcher.process_update(telegram.Update.de_json(data, dispatcher.bot))
+
+    workers = [threading.Thread(target=process, args=(local_queue,), name=f'webhook-{index}-{i}')
+               for i, local_queue in enumerate(local_queues)]
+    for worker in workers:
+        worker.start()
+
+    while True:
+        item = updates.get()
+        if item is None:
+            break
+        thread, data = item
+        local_queues[thread].put(data)
+
+    for local_queue in local_queues:
+        local_queue.put(None)
+    for worker in workers:
+        worker.join()
+    teardown()
+
+
+class WebhookPool:
+    """Webhook-сервер и processes процессов-воркеров по threads потоков в каждом"""
+
+    def __init__(self, setup, processes, threads, queue_size=1000):
+        self.setup = setup
+        self.threads = threads
+        # spawn: воркер не наследует потоки и соединения главного процесса
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue(queue_size) for _ in range(processes)]
+        self._processes = []
+        self._server = None
+
+    def qsize(self):
+        return sum(updates.qsize() for updates in self.queues)
+
+    def start(self, host, port, path, secret=None):
+        for index, updates in enumerate(self.queues):
+            process = self._context.Process(target=run_worker, args=(index, updates, self.threads, self.setup),
+                                            name=f'webhook-worker-{index}')
+            process.start()
+            self._processes.append(process)
+        self._server = WebhookServer(host, port, path, secret, self.queues, self.threads)
+        self._server.start()
+        logging.info(f'Webhook слушает {host}:{self._server.port}{path}, воркеров: {len(self._processes)}')
+
+    def stop(self, timeout=30.0):
+        """Останавливает прием обновлений и ждет, пока воркеры обработают принятые"""
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        for updates in self.queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning(f'{process.name} не завершился за {timeout} с, процесс остановлен')
+                process.terminate()
+                process.join()
+        self._processes.clear()
+
+    def wait(self):
+        """Блокирует до SIGINT или SIGTERM"""
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+        while not stop.wait(1.0):
+            for process in self._processes:
+                if not process.is_alive():
+                    logging.error(f'{process.name} неожиданно завершился с кодом {process.exitcode}')
+                    return